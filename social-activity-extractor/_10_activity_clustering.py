@@ -0,0 +1,114 @@
+import argparse
+import config
+import os
+import shutil
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.cluster import MiniBatchKMeans
+from tqdm import tqdm
+
+from model.util import LatentStore, ShardWriter
+
+
+CONFIG = config.Config
+
+def main():
+	parser = argparse.ArgumentParser(description='mini-batch k-means of post latents into activity clusters')
+	parser.add_argument('-target_dataset', type=str, default=None, help='folder name of target dataset')
+	parser.add_argument('-n_clusters', type=int, default=100, help='number of clusters')
+	parser.add_argument('-batch_size', type=int, default=4096, help='latents per k-means update')
+	parser.add_argument('-epochs', type=int, default=3, help='passes over the latent store')
+	parser.add_argument('-normalize', action='store_true', default=False, help='cluster l2-normalized latents')
+	parser.add_argument('-warm_start', action='store_true', default=False, help='start from the centroids of the previous run')
+	parser.add_argument('-num_workers', type=int, default=4, help='threads assigning shards to clusters')
+
+	args = parser.parse_args()
+
+	cluster_latents(args)
+
+def iter_batches(latent_store, batch_size, normalize, random_state):
+	# shards in random order, each shuffled and cut into batches, so only one shard is in memory
+	for shard_id in random_state.permutation(len(latent_store.latents.shards)):
+		shard = latent_store.latents.shards[shard_id]
+		order = random_state.permutation(len(shard))
+		for start in range(0, len(shard), batch_size):
+			yield prepare(shard[np.sort(order[start:start + batch_size])], normalize)
+
+def prepare(latents, normalize):
+	latents = np.asarray(latents, dtype=np.float32)
+	if normalize:
+		latents = latents / np.maximum(np.linalg.norm(latents, axis=1, keepdims=True), 1e-12)
+	return latents
+
+def fit_clusters(latent_store, n_clusters, batch_size, epochs, normalize, init_centroids=None):
+	random_state = np.random.RandomState(42)
+	if init_centroids is None:
+		kmeans = MiniBatchKMeans(n_clusters, batch_size=batch_size, random_state=42)
+		# k-means++ is seeded on the first partial_fit batch, so it gets a sample of the whole store
+		init_rows = np.sort(random_state.choice(len(latent_store), min(len(latent_store), max(batch_size, 3 * n_clusters)), replace=False))
+		kmeans.partial_fit(prepare(latent_store.get_latents(init_rows), normalize))
+	else:
+		kmeans = MiniBatchKMeans(n_clusters, init=init_centroids, n_init=1, batch_size=batch_size, random_state=42)
+	for epoch in range(epochs):
+		for latents in tqdm(iter_batches(latent_store, batch_size, normalize, random_state)):
+			kmeans.partial_fit(latents)
+		print("Epoch: {} inertia of the last batch: {}".format(epoch, kmeans.inertia_))
+	return kmeans
+
+def assign_clusters(kmeans, latent_store, normalize, cluster_path, num_workers):
+	# labels and centroid distances written shard by shard in latent store order
+	for prefix in ['labels', 'distances']:
+		for shard_path in [os.path.join(cluster_path, file) for file in os.listdir(cluster_path) if file.startswith(prefix + '_')]:
+			os.remove(shard_path)
+	label_writer = ShardWriter(cluster_path, 'labels', CONFIG.LATENT_SHARD_SIZE, np.int32)
+	distance_writer = ShardWriter(cluster_path, 'distances', CONFIG.LATENT_SHARD_SIZE, np.float32)
+	cluster_counts = np.zeros(kmeans.n_clusters, dtype=np.int64)
+
+	def assign(shard):
+		latents = prepare(shard, normalize)
+		labels = kmeans.predict(latents)
+		distances = np.linalg.norm(latents - kmeans.cluster_centers_[labels], axis=1)
+		return labels, distances
+
+	shards = latent_store.latents.shards
+	with ThreadPoolExecutor(max_workers=num_workers) as executor:
+		# at most `num_workers` shards are in flight at a time
+		for start in tqdm(range(0, len(shards), num_workers)):
+			for labels, distances in executor.map(assign, shards[start:start + num_workers]):
+				label_writer.append(labels)
+				distance_writer.append(distances)
+				cluster_counts += np.bincount(labels, minlength=kmeans.n_clusters)
+	label_writer.close()
+	distance_writer.close()
+	return cluster_counts
+
+def cluster_latents(args):
+	latent_path = os.path.join(CONFIG.LATENT_PATH, args.target_dataset)
+	cluster_path = os.path.join(CONFIG.CLUSTER_PATH, args.target_dataset)
+	if not os.path.exists(cluster_path):
+		os.makedirs(cluster_path)
+	latent_store = LatentStore(latent_path)
+
+	init_centroids = None
+	centroid_path = os.path.join(cluster_path, 'centroids.npy')
+	if args.warm_start and os.path.exists(centroid_path):
+		init_centroids = np.load(centroid_path)
+		args.n_clusters = len(init_centroids)
+		print("Warm start from {} centroids".format(args.n_clusters))
+
+	start = time.time()
+	kmeans = fit_clusters(latent_store, args.n_clusters, args.batch_size, args.epochs, args.normalize, init_centroids)
+	print("Fitted {} clusters in {:.1f}s".format(args.n_clusters, time.time() - start))
+	np.save(centroid_path, kmeans.cluster_centers_.astype(np.float32))
+
+	start = time.time()
+	cluster_counts = assign_clusters(kmeans, latent_store, args.normalize, cluster_path, args.num_workers)
+	# rows of labels_* and distances_* follow the shortcodes of the latent store
+	shutil.copyfile(os.path.join(latent_path, 'shortcodes.npy'), os.path.join(cluster_path, 'shortcodes.npy'))
+	print("Assigned {} latents in {:.1f}s".format(len(latent_store), time.time() - start))
+	print("Cluster sizes: min {} median {} max {}".format(cluster_counts.min(), int(np.median(cluster_counts)), cluster_counts.max()))
+
+
+if __name__ == '__main__':
+	main()
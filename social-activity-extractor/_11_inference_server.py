@@ -0,0 +1,282 @@
+import argparse
+import config
+import json
+import math
+import os
+import queue
+import threading
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchvision.models as models
+import torchvision.transforms as transforms
+from torchvision.datasets.folder import pil_loader
+from model import util
+from model import text_model, imgseq_model, multimodal_model
+from util import process_text
+
+
+CONFIG = config.Config
+
+def main():
+	parser = argparse.ArgumentParser(description='local micro-batching inference server of the multimodal encoder')
+	parser.add_argument('-tau', type=float, default=0.01, help='temperature parameter')
+	parser.add_argument('-target_dataset', type=str, default=None, help='folder name of the dataset the model was trained on')
+	# model
+	parser.add_argument('-latent_size', type=int, default=900, help='size of latent variable')
+	parser.add_argument('-filter_size', type=int, default=300, help='filter size of convolution')
+	parser.add_argument('-filter_shape', type=int, default=5,
+						help='filter shape to use for convolution')
+	parser.add_argument('-arch', type=str, default='resnext101_32x8d', help='image embedding model')
+	parser.add_argument('-image_embedding_dim', type=int, default=2048, help='embedding dimension of the model')
+	parser.add_argument('-num_layer', type=int, default=4, help='layer number')
+	parser.add_argument('-gpu', type=str, default='cuda', help='gpu number')
+	parser.add_argument('-checkpoint', type=str, default=None, help='filename of checkpoint to serve')
+	parser.add_argument('-raw_images', action='store_true', default=False, help='also load the image model to accept image files')
+	# server
+	parser.add_argument('-host', type=str, default='127.0.0.1', help='address to listen on')
+	parser.add_argument('-port', type=int, default=8000, help='port to listen on')
+	parser.add_argument('-max_batch_size', type=int, default=64, help='most posts encoded in one forward pass')
+	parser.add_argument('-max_latency', type=float, default=10., help='ms a request waits for others to join its batch')
+	parser.add_argument('-stats_interval', type=float, default=60., help='seconds between latency reports, 0 disables them')
+
+	args = parser.parse_args()
+
+	serve(args)
+
+class last_layer(nn.Module):
+	def __init__(self):
+		super(last_layer, self).__init__()
+
+	def forward(self, x):
+		normalized_x = F.normalize(x, p=2, dim=1)
+		return normalized_x
+
+class MicroBatcher:
+	# coalesces concurrent requests into one forward pass of at most `max_batch_size` posts,
+	# a batch is closed `max_latency` seconds after its first request arrived
+	def __init__(self, encode_batch, max_batch_size, max_latency):
+		self.encode_batch = encode_batch
+		self.max_batch_size = max_batch_size
+		self.max_latency = max_latency
+		self.requests = queue.Queue()
+		self.latencies = deque(maxlen=10000)
+		self.finish_times = deque(maxlen=10000)
+		self.batch_sizes = deque(maxlen=1000)
+		self.lock = threading.Lock()
+		self.worker = threading.Thread(target=self.run, daemon=True)
+		self.worker.start()
+
+	def submit(self, text, imgseq, imgseq_len):
+		future = Future()
+		self.requests.put((text, imgseq, imgseq_len, future, time.time()))
+		return future
+
+	def run(self):
+		while True:
+			batch = [self.requests.get()]
+			deadline = batch[0][4] + self.max_latency
+			while len(batch) < self.max_batch_size:
+				timeout = deadline - time.time()
+				if timeout <= 0:
+					break
+				try:
+					batch.append(self.requests.get(timeout=timeout))
+				except queue.Empty:
+					break
+			try:
+				latents = self.encode_batch(np.stack([request[0] for request in batch]), np.stack([request[1] for request in batch]), np.array([request[2] for request in batch]))
+			except Exception as e:
+				for request in batch:
+					request[3].set_exception(e)
+				continue
+			finish_time = time.time()
+			for request, latent in zip(batch, latents):
+				request[3].set_result(latent)
+			with self.lock:
+				self.latencies.extend([finish_time - request[4] for request in batch])
+				self.finish_times.extend([finish_time] * len(batch))
+				self.batch_sizes.append(len(batch))
+
+	def stats(self):
+		# latency percentiles and throughput of the last 10000 requests
+		with self.lock:
+			latencies = np.array(self.latencies)
+			finish_times = np.array(self.finish_times)
+			batch_sizes = np.array(self.batch_sizes)
+		if len(latencies) == 0:
+			return {'requests': 0}
+		elapsed = finish_times[-1] - finish_times[0]
+		return {
+			'requests': len(latencies),
+			'p50_ms': float(np.percentile(latencies, 50) * 1000),
+			'p99_ms': float(np.percentile(latencies, 99) * 1000),
+			'throughput': float(len(latencies) / elapsed) if elapsed > 0 else None,
+			'mean_batch_size': float(batch_sizes.mean())
+		}
+
+class PostEncoder:
+	# turns one request into the (text, imgseq, imgseq_len) arrays the encoder takes
+	def __init__(self, vocab, image_model, image_embedding_dim, device):
+		self.vocab = vocab
+		self.image_model = image_model
+		self.image_embedding_dim = image_embedding_dim
+		self.device = device
+		self.img_transform = transforms.Compose([
+					transforms.Resize(256),
+					transforms.CenterCrop(224),
+					transforms.ToTensor(),
+					transforms.Normalize(mean=[0.485, 0.456, 0.406],
+									 std=[0.229, 0.224, 0.225])
+				])
+
+	def encode_text(self, request):
+		if isinstance(request.get('text'), str):
+			word_list = request['text'].split()
+		elif isinstance(request.get('caption'), str):
+			word_list = process_text(request['caption'])
+		else:
+			raise ValueError("request needs a string `text` (tokenized) or `caption` (raw)")
+		# words the model never saw are the rare words that became UNK in the dataset
+		word_list = [word if word in self.vocab else 'UNK' for word in word_list]
+		if len(word_list) == 0 or word_list[-1] != '<EOS>':
+			word_list.append('<EOS>')
+		if len(word_list) > CONFIG.MAX_SENTENCE_LEN:
+			word_list = word_list[:CONFIG.MAX_SENTENCE_LEN]
+			word_list[-1] = '<EOS>'
+		else:
+			word_list = word_list + ['<PAD>'] * (CONFIG.MAX_SENTENCE_LEN - len(word_list))
+		return self.vocab.get_indices(word_list).astype(np.int64)
+
+	def encode_images(self, request):
+		if 'image_features' in request:
+			image_features = np.asarray(request['image_features'], dtype=np.float32)
+		elif 'images' in request:
+			if self.image_model is None:
+				raise ValueError("start the server with -raw_images to send image files")
+			images = torch.stack([self.img_transform(pil_loader(image_path)) for image_path in request['images'][:CONFIG.MAX_SEQUENCE_LEN]])
+			with torch.no_grad():
+				image_features = self.image_model(images.to(self.device)).cpu().numpy()
+		else:
+			raise ValueError("request needs `image_features` or `images`")
+		# one row per image, or the batch of the micro batcher cannot be stacked
+		if image_features.ndim != 2 or image_features.shape[1] != self.image_embedding_dim:
+			raise ValueError("image features need the shape (n, {})".format(self.image_embedding_dim))
+		image_features = image_features[:CONFIG.MAX_SEQUENCE_LEN]
+		if len(image_features) == 0:
+			raise ValueError("request needs at least one image")
+		return np.pad(image_features, ((0, CONFIG.MAX_SEQUENCE_LEN - len(image_features)), (0, 0)), "constant", constant_values=0.), len(image_features)
+
+def load_encoder(args, device):
+	print("Loading embedding model...")
+	text_embedding_model = util.load_embedding_matrix(CONFIG, args.target_dataset)
+	vocab = util.Vocabulary.load(os.path.join(CONFIG.DATASET_PATH, args.target_dataset))
+	print("Loading embedding model completed")
+	t1 = CONFIG.MAX_SENTENCE_LEN
+	t2 = int(math.floor((t1 - args.filter_shape) / 2) + 1) # "2" means stride size
+	t3 = int(math.floor((t2 - args.filter_shape) / 2) + 1)
+
+	text_embedding = nn.Embedding.from_pretrained(text_embedding_model)
+	text_encoder = text_model.ConvolutionEncoder(text_embedding, t3, args.filter_size, args.filter_shape, args.latent_size)
+	imgseq_encoder = imgseq_model.RNNEncoder(args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
+	multimodal_encoder = multimodal_model.MultimodalEncoder(text_encoder, imgseq_encoder, args.latent_size)
+	checkpoint = torch.load(os.path.join(CONFIG.CHECKPOINT_PATH, args.checkpoint), map_location=lambda storage, loc: storage)
+	util.load_weights(multimodal_encoder, checkpoint['multimodal_encoder'])
+	# captions of a bucketed checkpoint are encoded at the length of their bucket
+	if checkpoint.get('buckets'):
+		multimodal_encoder = multimodal_model.BucketedEncoder(multimodal_encoder, checkpoint['buckets'], vocab['<PAD>'])
+	multimodal_encoder.to(device)
+	multimodal_encoder.eval()
+	# checkpoints trained before packed sequences read the padded image sequences
+	packed_sequences = checkpoint.get('packed_sequences', False)
+
+	image_model = None
+	if args.raw_images:
+		image_model = models.__dict__[args.arch](pretrained=True)
+		image_model.fc = last_layer()
+		image_model.eval()
+		image_model.to(device)
+	return multimodal_encoder, packed_sequences, vocab, image_model
+
+def make_handler(post_encoder, batcher):
+	class InferenceHandler(BaseHTTPRequestHandler):
+		def send_json(self, status, body):
+			data = json.dumps(body).encode('utf-8')
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(data)))
+			self.end_headers()
+			self.wfile.write(data)
+
+		def do_GET(self):
+			if self.path == '/stats':
+				self.send_json(200, batcher.stats())
+			else:
+				self.send_json(404, {'error': 'unknown path'})
+
+		def do_POST(self):
+			if self.path != '/encode':
+				self.send_json(404, {'error': 'unknown path'})
+				return
+			try:
+				if self.headers['Content-Length'] is None:
+					raise ValueError("request needs a Content-Length header")
+				request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+				if not isinstance(request, dict):
+					raise ValueError("request needs to be a JSON object")
+				text = post_encoder.encode_text(request)
+				imgseq, imgseq_len = post_encoder.encode_images(request)
+			except (ValueError, KeyError, TypeError, OSError) as e:
+				self.send_json(400, {'error': str(e)})
+				return
+			try:
+				latent = batcher.submit(text, imgseq, imgseq_len).result()
+			except Exception as e:
+				self.send_json(500, {'error': str(e)})
+				return
+			self.send_json(200, {'latent': latent.tolist()})
+
+		def log_message(self, format, *args):
+			pass
+
+	return InferenceHandler
+
+def serve(args):
+	device = torch.device(args.gpu)
+	multimodal_encoder, packed_sequences, vocab, image_model = load_encoder(args, device)
+
+	def encode_batch(text_batch, imgseq_batch, imgseq_len_batch):
+		with torch.no_grad():
+			text_feature = torch.from_numpy(text_batch).to(device)
+			imgseq_feature = torch.from_numpy(imgseq_batch).to(device)
+			imgseq_len = torch.from_numpy(imgseq_len_batch) if packed_sequences else None
+			return multimodal_encoder(text_feature, imgseq_feature, imgseq_len).cpu().numpy()
+
+	batcher = MicroBatcher(encode_batch, args.max_batch_size, args.max_latency / 1000)
+	post_encoder = PostEncoder(vocab, image_model, args.image_embedding_dim, device)
+
+	if args.stats_interval > 0:
+		def report_stats():
+			while True:
+				time.sleep(args.stats_interval)
+				print("Stats: {}".format(batcher.stats()))
+		threading.Thread(target=report_stats, daemon=True).start()
+
+	server = ThreadingHTTPServer((args.host, args.port), make_handler(post_encoder, batcher))
+	print("Serving on http://{}:{}".format(args.host, args.port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
+	print("Stats: {}".format(batcher.stats()))
+
+
+if __name__ == '__main__':
+	main()
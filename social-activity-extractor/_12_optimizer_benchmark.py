@@ -0,0 +1,97 @@
+import argparse
+import config
+import copy
+import math
+import time
+
+import torch
+import torch.nn as nn
+from model import text_model, imgseq_model, multimodal_model
+from model.component import AdamW
+
+
+CONFIG = config.Config
+
+def main():
+	parser = argparse.ArgumentParser(description='per-parameter loop against foreach AdamW on the multimodal autoencoder parameters')
+	parser.add_argument('-steps', type=int, default=100, help='optimizer steps timed per implementation')
+	parser.add_argument('-weight_decay', type=float, default=1e-05, help='initial weight decay')
+	parser.add_argument('-tau', type=float, default=0.01, help='temperature parameter')
+	# model
+	parser.add_argument('-vocab_size', type=int, default=50000, help='number of words of the embedding matrix')
+	parser.add_argument('-embedding_dim', type=int, default=300, help='dimension of the word embedding')
+	parser.add_argument('-latent_size', type=int, default=900, help='size of latent variable')
+	parser.add_argument('-filter_size', type=int, default=300, help='filter size of convolution')
+	parser.add_argument('-filter_shape', type=int, default=5,
+						help='filter shape to use for convolution')
+	parser.add_argument('-image_embedding_dim', type=int, default=2048, help='embedding dimension of the model')
+	parser.add_argument('-num_layer', type=int, default=4, help='layer number')
+	parser.add_argument('-gpu', type=str, default='cuda', help='gpu number')
+
+	args = parser.parse_args()
+
+	benchmark(args)
+
+def build_autoencoder(args, device):
+	# the model of _5_multimodal_autoencoder with a random embedding matrix in place of the trained one
+	t1 = CONFIG.MAX_SENTENCE_LEN
+	t2 = int(math.floor((t1 - args.filter_shape) / 2) + 1) # "2" means stride size
+	t3 = int(math.floor((t2 - args.filter_shape) / 2) + 1)
+	text_embedding = nn.Embedding.from_pretrained(torch.randn(args.vocab_size, args.embedding_dim))
+	text_encoder = text_model.ConvolutionEncoder(text_embedding, t3, args.filter_size, args.filter_shape, args.latent_size)
+	text_decoder = text_model.DeconvolutionDecoder(text_embedding, args.tau, t3, args.filter_size, args.filter_shape, args.latent_size, device)
+	imgseq_encoder = imgseq_model.RNNEncoder(args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
+	imgseq_decoder = imgseq_model.RNNDecoder(CONFIG.MAX_SEQUENCE_LEN, args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
+	multimodal_encoder = multimodal_model.MultimodalEncoder(text_encoder, imgseq_encoder, args.latent_size)
+	multimodal_decoder = multimodal_model.MultimodalDecoder(text_decoder, imgseq_decoder, args.latent_size, CONFIG.MAX_SEQUENCE_LEN)
+	return multimodal_model.MultimodalAutoEncoder(multimodal_encoder, multimodal_decoder).to(device)
+
+def time_steps(model, grads, foreach, steps, weight_decay, device):
+	# seconds per step and the optimizer after `steps` steps on the same fixed gradients
+	optimizer = AdamW(model.parameters(), lr=1e-4, weight_decay=weight_decay, amsgrad=True, foreach=foreach)
+	for p, grad in zip(model.parameters(), grads):
+		p.grad = grad
+	# first steps allocate the optimizer state
+	for _ in range(3):
+		optimizer.step()
+	if device.type == 'cuda':
+		torch.cuda.synchronize(device)
+	start = time.time()
+	for _ in range(steps):
+		optimizer.step()
+	if device.type == 'cuda':
+		torch.cuda.synchronize(device)
+	return (time.time() - start) / steps, optimizer
+
+def benchmark(args):
+	device = torch.device(args.gpu)
+	torch.manual_seed(42)
+	autoencoder = build_autoencoder(args, device)
+	params = [p for p in autoencoder.parameters() if p.requires_grad]
+	print("Parameters: {} tensors, {} values".format(len(params), sum([p.numel() for p in params])))
+	grads = [torch.randn_like(p) * 1e-3 if p.requires_grad else None for p in autoencoder.parameters()]
+
+	loop_model = copy.deepcopy(autoencoder)
+	foreach_model = copy.deepcopy(autoencoder)
+	loop_time, loop_optimizer = time_steps(loop_model, grads, False, args.steps, args.weight_decay, device)
+	foreach_time, foreach_optimizer = time_steps(foreach_model, grads, True, args.steps, args.weight_decay, device)
+	print("loop: {:.2f}ms foreach: {:.2f}ms per step, speedup {:.2f}x".format(loop_time * 1000, foreach_time * 1000, loop_time / foreach_time))
+
+	max_diff = max([(p - q).abs().max().item() for p, q in zip(loop_model.parameters(), foreach_model.parameters())])
+	print("Parity: max abs parameter difference {:.2e} after {} steps".format(max_diff, args.steps + 3))
+
+	# the loop state dict as checkpoints saved before the foreach update have it
+	state_dict = loop_optimizer.state_dict()
+	for group in state_dict['param_groups']:
+		del group['foreach']
+	resumed_optimizer = AdamW(loop_model.parameters(), lr=1e-4, weight_decay=args.weight_decay, amsgrad=True)
+	resumed_optimizer.load_state_dict(state_dict)
+	resumed_optimizer.param_groups[0]['foreach'] = True
+	resumed_optimizer.step()
+	foreach_optimizer.step()
+	max_diff = max([(p - q).abs().max().item() for p, q in zip(loop_model.parameters(), foreach_model.parameters())])
+	print("Resume: max abs parameter difference {:.2e} after a foreach step from an old state dict".format(max_diff))
+
+
+if __name__ == '__main__':
+	main()
@@ -27,32 +27,39 @@ from gensim.test.utils import datapath
 #from polyglot.detect import Detector
 
 
-from util import process_text
+from util import iter_process_text, TokenCache
+from model.util import Vocabulary
 CONFIG = config.Config
 # okt=Okt()
 
-def make_corpus(target_folder):
+def make_corpus(target_folder, num_workers=CONFIG.TOKENIZER_WORKERS):
 	print(target_folder)
 	corpus_name = target_folder + '.txt'
 	f_wr = open(os.path.join(CONFIG.DATA_PATH, 'corpus', corpus_name), 'w', encoding='utf-8')
 	text_path = os.path.join(CONFIG.DATA_PATH, target_folder)
 	text_folder_list = os.listdir(text_path)
-	count = 0
 	# languages_dic = dict()
+	text_file_list = []
 	for text_folder in text_folder_list:
 		# print("folder: ", text_folder)
 		text_files = os.listdir(os.path.join(text_path, text_folder))
 		for text_file in text_files:
 			if text_file.endswith('.txt') and not text_file.endswith('_location.txt'):
-				if count % 100 == 0: 
-					print(count)
-				with open(os.path.join(text_path, text_folder, text_file), 'r', encoding='utf-8', newline='\n') as f:
-					# print("file: ", text_file)
-					data = f.read()
-					line = process_text(data)
-					if len(line) > 0:
-						f_wr.write(line + ' <EOS> <PAD>\n')
-				count = count + 1
+				text_file_list.append(os.path.join(text_path, text_folder, text_file))
+
+	def read_text_files():
+		for text_file in text_file_list:
+			with open(text_file, 'r', encoding='utf-8', newline='\n') as f:
+				yield f.read()
+
+	count = 0
+	with TokenCache(CONFIG.TOKEN_CACHE_PATH) as cache:
+		for line in iter_process_text(read_text_files(), num_workers, CONFIG.TOKENIZER_CHUNKSIZE, cache):
+			if count % 100 == 0: 
+				print(count)
+			if len(line) > 0:
+				f_wr.write(' '.join(line) + ' <EOS> <PAD>\n')
+			count = count + 1
 	f_wr.close()
 	# csv_name = target_folder + '_meta.csv'
 	# with open(os.path.join(CONFIG.CSV_PATH, csv_name), 'w', encoding='utf-8-sig', newline='') as f:
@@ -221,27 +228,15 @@ def make_word2vec(target_corpus):
 	embedding_model.wv.save(os.path.join(CONFIG.EMBEDDING_PATH, model_name))
 
 	vocab_list = list(embedding_model.wv.vocab)
-	idx2word = {}
-	word2idx = {}
-	word_vectors = []
-	for idx, word in enumerate(vocab_list):
-		idx2word[idx] = word
-		word2idx[word] = idx
-		word_vectors.append(embedding_model.wv[word])
+	word_vectors = [embedding_model.wv[word] for word in vocab_list]
 	
-	n_words = len(word2idx)
-	word2idx["<PAD>"] = n_words
-	idx2word[n_words] = "<PAD>"
+	vocab_list.append("<PAD>")
 	pad_array = np.full(embedding_size, pad_value)
 	pad_array = pad_array / np.linalg.norm(pad_array, axis=0, ord=2, keepdims=True)
 	word_vectors.append(pad_array)
 	word_array = np.array(word_vectors, dtype=np.float32)
-	with open(os.path.join(CONFIG.DATASET_PATH, target_corpus, 'word_idx.json'), "w", encoding='utf-8') as f:
-		f.write(json.dumps([idx2word, word2idx]))
-	f.close()
-	with open(os.path.join(CONFIG.DATASET_PATH, target_corpus, 'word_embedding.p'), 'wb') as f:
-		cPickle.dump(word_array, f)
-	f.close()
+	Vocabulary(vocab_list).save(os.path.join(CONFIG.DATASET_PATH, target_corpus))
+	np.save(os.path.join(CONFIG.DATASET_PATH, target_corpus, 'word_embedding.npy'), word_array)
 	print(word_array.shape)
 	print("embedding completed")
 
@@ -327,7 +322,7 @@ def make_fasttext_pretrained(target_corpus, pretrined_model):
 
 def run(option):
 	if option == 0:
-		make_corpus(target_folder=sys.argv[2])
+		make_corpus(target_folder=sys.argv[2], num_workers=int(sys.argv[3]) if len(sys.argv) > 3 else CONFIG.TOKENIZER_WORKERS)
 	elif option == 1:
 		make_fasttext(target_dataset=sys.argv[2])
 	elif option == 2:
@@ -19,7 +19,10 @@ from tqdm import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import torchvision.models as models
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch.autograd import Variable
 from torch.optim.adam import Adam
@@ -63,6 +66,8 @@ def main():
 	# train
 	parser.add_argument('-noti', action='store_true', default=False, help='whether using gpu server')
 	parser.add_argument('-gpu', type=str, default='cuda', help='gpu number')
+	parser.add_argument('-world_size', type=int, default=1, help='local processes training with DistributedDataParallel on cpu, 1 trains in this process on -gpu')
+	parser.add_argument('-master_port', type=int, default=29500, help='port the processes of distributed training meet on')
 	# option
 	parser.add_argument('-resume', type=str, default=None, help='filename of checkpoint to resume ')
 
@@ -70,18 +75,28 @@ def main():
 
 	if args.noti:
 		slacknoti("underkoo start using")
-	train_reconstruction(args)
+	if args.world_size > 1:
+		# every process draws the same train/validation split from this seed
+		args.seed = int(np.random.randint(2 ** 31))
+		mp.spawn(train_reconstruction, args=(args,), nprocs=args.world_size)
+	else:
+		train_reconstruction(0, args)
 	if args.noti:
 		slacknoti("underkoo end using")
 
 
-def train_reconstruction(args):
-	device = torch.device(args.gpu)
+def train_reconstruction(rank, args):
+	if args.world_size > 1:
+		util.init_distributed(rank, args.world_size, args.master_port)
+		torch.manual_seed(args.seed)
+		device = torch.device('cpu')
+	else:
+		device = torch.device(args.gpu)
 	print("Loading dataset...")
 	train_dataset, val_dataset = load_imgseq_data(args, CONFIG)
 	print("Loading dataset completed")
-	train_loader, val_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=args.shuffle),\
-								  DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False)
+	train_loader, val_loader = util.get_batch_loader(train_dataset, args.batch_size, args.shuffle, rank=rank, world_size=args.world_size),\
+								  util.get_batch_loader(val_dataset, args.batch_size, False, rank=rank, world_size=args.world_size, even_shards=False)
 
 	imgseq_encoder = imgseq_model.RNNEncoder(args.embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
 	imgseq_decoder = imgseq_model.RNNDecoder(CONFIG.MAX_SEQUENCE_LEN, args.embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
@@ -96,10 +111,18 @@ def train_reconstruction(args):
 		start_epoch = 0
 	
 	imgseq_autoencoder = imgseq_model.ImgseqAutoEncoder(imgseq_encoder, imgseq_decoder)
-	criterion = nn.MSELoss().to(device)
+	criterion = imgseq_model.MaskedMSELoss().to(device)
 	imgseq_autoencoder.to(device)
+	if args.world_size > 1:
+		# dropout differs between the processes
+		torch.manual_seed(args.seed + rank)
+		# buffers are not broadcast every step, batch norm statistics are averaged every epoch instead
+		train_autoencoder = DistributedDataParallel(imgseq_autoencoder, broadcast_buffers=False)
+	else:
+		train_autoencoder = imgseq_autoencoder
 
 	optimizer = AdamW(imgseq_autoencoder.parameters(), lr=1., weight_decay=args.weight_decay, amsgrad=True)
+	# len(train_loader) counts the batches of one process, so a half cycle stays `half_cycle_interval` epochs at any world size
 	step_size = args.half_cycle_interval*len(train_loader)
 	clr = cyclical_lr(step_size, min_lr=args.lr, max_lr=args.lr*args.lr_factor)
 	scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, [clr])
@@ -109,34 +132,39 @@ def train_reconstruction(args):
 		scheduler.load_state_dict(checkpoint['scheduler'])
 
 
-	exp = Experiment("Image-sequence autoencoder", capture_io=False)
-
-	for arg, value in vars(args).items():
-		exp.param(arg, value) 
+	exp = None
+	if rank == 0:
+		exp = Experiment("Image-sequence autoencoder", capture_io=False)
+		for arg, value in vars(args).items():
+			exp.param(arg, value) 
 	try:
 		imgseq_autoencoder.train() 
 
 		for epoch in range(start_epoch, args.epochs):
 			print("Epoch: {}".format(epoch))
-			for steps, batch in enumerate(train_loader):
+			util.set_loader_epoch(train_loader, epoch)
+			for steps, (batch, batch_len) in enumerate(train_loader):
 				torch.cuda.empty_cache()
 				feature = Variable(batch).to(device)
 				optimizer.zero_grad()
-				feature_hat = imgseq_autoencoder(feature)
-				loss = criterion(feature_hat, feature)
+				feature_hat = train_autoencoder(feature, batch_len)
+				loss = criterion(feature_hat, feature, batch_len)
 				loss.backward()
 				optimizer.step()
 				scheduler.step()
 
-				if (steps * args.batch_size) % args.log_interval == 0:
+				if rank == 0 and (steps * args.batch_size) % args.log_interval == 0:
 					print("Epoch: {} at {} lr: {}".format(epoch, str(datetime.datetime.now()), str(scheduler.get_lr())))
 					print("Steps: {}".format(steps))
 					print("Loss: {}".format(loss.detach().item()))
 					input_data = feature[0]
 				del feature, feature_hat, loss
 			
-			exp.log("\nEpoch: {} at {} lr: {}".format(epoch, str(datetime.datetime.now()), str(scheduler.get_lr())))
+			util.average_buffers(imgseq_autoencoder)
 			_avg_loss = eval_reconstruction(imgseq_autoencoder, criterion, val_loader, device)
+			if rank != 0:
+				continue
+			exp.log("\nEpoch: {} at {} lr: {}".format(epoch, str(datetime.datetime.now()), str(scheduler.get_lr())))
 			exp.log("\nEvaluation - loss: {}".format(_avg_loss))
 
 			util.save_models({
@@ -144,6 +172,7 @@ def train_reconstruction(args):
 				'imgseq_encoder': imgseq_encoder.state_dict(),
 				'imgseq_decoder': imgseq_decoder.state_dict(),
 				'avg_loss': _avg_loss,
+				'packed_sequences': True,
 				'optimizer' : optimizer.state_dict(),
 				'scheduler' : scheduler.state_dict()
 			}, CONFIG.CHECKPOINT_PATH, "imgseq_autoencoder")
@@ -151,7 +180,10 @@ def train_reconstruction(args):
 		print("Finish!!!")
 
 	finally:
-		exp.end()
+		if exp is not None:
+			exp.end()
+		if args.world_size > 1:
+			dist.destroy_process_group()
 
 def eval_reconstruction(autoencoder,criterion, data_iter, device):
 	print("=================Eval======================")
@@ -160,15 +192,17 @@ def eval_reconstruction(autoencoder,criterion, data_iter, device):
 	avg_loss = 0.
 	rouge_1 = 0.
 	rouge_2 = 0.
-	for batch in tqdm(data_iter):
+	for batch, batch_len in tqdm(data_iter, disable=not util.is_main_process()):
 		torch.cuda.empty_cache()
 		with torch.no_grad():
 			feature = Variable(batch).to(device)
-		feature_hat = autoencoder(feature)
-		loss = criterion(feature_hat, feature)	
+		feature_hat = autoencoder(feature, batch_len)
+		loss = criterion(feature_hat, feature, batch_len)	
 		avg_loss += loss.detach().item()
 		step = step + 1
 		del feature, feature_hat, loss
+	# every process evaluated its own shard of the validation data
+	avg_loss, step = util.all_reduce_sum([avg_loss, step])
 	avg_loss = avg_loss / step
 	print("Evaluation - loss: {}".format(avg_loss))
 	print("===============================================================")
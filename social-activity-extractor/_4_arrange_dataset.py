@@ -6,6 +6,9 @@ import re
 import sys
 import csv
 import random
+import json
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import _pickle as cPickle
 import numpy as np
 import pandas as pd
@@ -18,86 +21,115 @@ import torch.nn.functional as F
 import torchvision.models as models
 import torchvision.transforms as transforms
 from torchvision.datasets.folder import pil_loader
+from torch.utils.data import Dataset, DataLoader
 from gensim.models.keyedvectors import FastTextKeyedVectors
 from gensim.similarities.index import AnnoyIndexer
 
-from util import process_text
+from model.util import ImageFeatureWriter, ImageFeatureStore
+from util import iter_process_text, process_text_list, TokenCache
 
 CONFIG = config.Config
 
-def copy_selected_post(target_folder):
+def image_index(file):
+	# images of a post are <post>_UTC_1.jpg ... <post>_UTC_10.jpg, or <post>_UTC.jpg for a single one
+	index = os.path.splitext(file)[0].rsplit('_', 1)[-1]
+	return int(index) if index.isdigit() else 0
 
-	path_to_posts = {}
-	data_path = os.path.join(CONFIG.DATA_PATH, target_folder)
-
-	for directory in os.listdir(data_path):
-		path_dir = os.path.join(data_path, directory)
-		path_to_posts[directory] = []
-		for file in os.listdir(path_dir):
-			if file.endswith('UTC.txt'):
-				path_to_posts[directory].append(file)
+def move_post(path_dir, path_to_post, post_dic, line):
+	os.makedirs(os.path.join(path_to_post, "images"), exist_ok=True)
+	shutil.move(os.path.join(path_dir, post_dic["json"]), os.path.join(path_to_post, "meta.json"))
+	for idx, img in enumerate(post_dic["img"]):
+		img_name = "image_" + str(idx) + ".jpg"
+		shutil.move(os.path.join(path_dir, img), os.path.join(path_to_post, "images", img_name))
+	with open(os.path.join(path_to_post, "text.txt"), 'w', encoding='utf-8') as f_wr:
+		f_wr.write(line + ' <EOS>\n')
 
-	print("Total # of locations: ", len(path_to_posts))
+def copy_selected_post(target_folder, num_threads=16):
 
 	data_path = os.path.join(CONFIG.DATA_PATH, target_folder)
+	location_list = os.listdir(data_path)
+	print("Total # of locations: ", len(location_list))
+
 	dataset_path = os.path.join(CONFIG.DATASET_PATH, target_folder)
 	if not os.path.exists(dataset_path):
 		os.mkdir(dataset_path)
-	count = 0
-	for directory, posts in path_to_posts.items():
+	cache = TokenCache(CONFIG.TOKEN_CACHE_PATH)
+	executor = ThreadPoolExecutor(max_workers=num_threads)
+	for count, directory in enumerate(location_list):
 		print(str(count), "th Location directory: ", directory)
 		path_dir = os.path.join(data_path, directory)
 
+		# scan the location once and group its files by post name (the '..._UTC' prefix)
+		path_to_posts = {}
+		with os.scandir(path_dir) as entries:
+			for entry in entries:
+				file = entry.name
+				if file.endswith('location.txt'):
+					os.remove(entry.path)
+					continue
+				if not file.endswith('.jpg') and not file.endswith('.txt') and not file.endswith('.json'):
+					os.remove(entry.path)
+					continue
+				if 'UTC' not in file:
+					continue
+				post_name = file[:file.index('UTC') + 3]
+				post_dic = path_to_posts.setdefault(post_name, {"img":[], "text":"", "json":""})
+				if file.endswith('.jpg'):
+					post_dic['img'].append(file)
+				elif file == post_name + '.json':
+					post_dic['json'] = file
+				elif file == post_name + '.txt':
+					post_dic['text'] = file
 
-		for file in os.listdir(path_dir):
-			if file.endswith('location.txt'):
-				os.remove(os.path.join(path_dir, file))
-				continue
-			if not file.endswith('.jpg') and not file.endswith('.txt') and not file.endswith('.json'):
-				os.remove(os.path.join(path_dir, file))
-				continue
-
-		for post in tqdm(posts):
-			post_name = post.replace(".txt", "")
-			post_dic = {"img":[], "text":"", "json":""}
-			for file in os.listdir(path_dir):
-				if file.startswith(post_name):
-					if file.endswith('.jpg'):
-						post_dic['img'].append(file)
-					elif file.endswith('.json'):
-						post_dic['json'] = file
-					elif file.endswith('.txt') and not file.endswith('location.txt'):
-						post_dic['text'] = file
-					else:
-						pass
-
+		selected_posts = []
+		text_list = []
+		for post_name, post_dic in path_to_posts.items():
 			if len(post_dic["img"]) > 0 and post_dic["text"] != "" and post_dic["json"] != "":
-
+				post_dic["img"].sort(key=image_index)
 				with open(os.path.join(path_dir, post_dic["text"]), 'r', encoding='utf-8', newline='\n') as f:
-					# print("file: ", text_file)
-					data = f.read()
-					line = process_text(data)
-					if len(line) > 0:						
-						path_to_location = os.path.join(dataset_path, directory)
-						if not os.path.exists(path_to_location):
-							os.mkdir(path_to_location)
-						path_to_post = os.path.join(dataset_path, directory, post_name)
-						if not os.path.exists(path_to_post):
-							os.mkdir(path_to_post)
-						shutil.move(os.path.join(path_dir, post_dic["json"]), os.path.join(path_to_post, "meta.json"))
-						os.mkdir(os.path.join(path_to_post, "images"))
-						for idx, img in enumerate(post_dic["img"]):
-							img_name = "image_" + str(idx) + ".jpg"
-							shutil.move(os.path.join(path_dir, img), os.path.join(path_to_post, "images", img_name))
-						f_wr = open(os.path.join(path_to_post, "text.txt"), 'w', encoding='utf-8')
-						f_wr.write(line + ' <EOS>\n')
-						f_wr.close()
-				f.close()
+					text_list.append(f.read())
+				selected_posts.append((post_name, post_dic))
+
+		futures = []
+		for (post_name, post_dic), word_list in zip(selected_posts, process_text_list(text_list, cache=cache)):
+			line = ' '.join(word_list)
+			if len(line) > 0:
+				path_to_post = os.path.join(dataset_path, directory, post_name)
+				futures.append(executor.submit(move_post, path_dir, path_to_post, post_dic, line))
+		for future in tqdm(as_completed(futures), total=len(futures)):
+			future.result()
 		shutil.rmtree(path_dir)
-		count = count + 1
+	executor.shutdown()
+	cache.close()
 
 	print("Copy completed")
 
+def read_post_meta(meta_path):
+	with open(meta_path, 'r', encoding='utf-8') as f:
+		node = json.load(f)['node']
+	return node['shortcode'], node['taken_at_timestamp']
+
+def make_post_meta(target_dataset, num_threads=16):
+	# shortcode, location and timestamp of every post copied by `copy_selected_post`,
+	# the location is the name of the directory the post was crawled into
+	dataset_path = os.path.join(CONFIG.DATASET_PATH, target_dataset)
+	short_codes = []
+	loc_ids = []
+	timestamps = []
+	with ThreadPoolExecutor(max_workers=num_threads) as executor:
+		for loc_entry in tqdm(list(os.scandir(dataset_path))):
+			if not loc_entry.is_dir():
+				continue
+			meta_paths = [os.path.join(post_entry.path, 'meta.json') for post_entry in os.scandir(loc_entry.path) if post_entry.is_dir()]
+			meta_paths = [meta_path for meta_path in meta_paths if os.path.exists(meta_path)]
+			for short_code, timestamp in executor.map(read_post_meta, meta_paths):
+				short_codes.append(short_code)
+				loc_ids.append(loc_entry.name.lstrip('%'))
+				timestamps.append(timestamp)
+	np.savez(os.path.join(dataset_path, 'post_meta.npz'), short_codes=np.array(short_codes, dtype=str),
+			 loc_ids=np.array(loc_ids, dtype=str), timestamps=np.array(timestamps, dtype=np.int64))
+	print("Posts with metadata: ", len(short_codes))
+
 class last_layer(nn.Module):
 	def __init__(self):
 		super(last_layer, self).__init__()
@@ -106,7 +138,36 @@ class last_layer(nn.Module):
 		normalized_x = F.normalize(x, p=2, dim=1)
 		return normalized_x
 
-def embedding_images(target_dataset, arch, gpu):
+class ImagePickleDataset(Dataset):
+	def __init__(self, original_path):
+		self.original_path = original_path
+		self.image_paths = os.listdir(original_path)
+
+	def __len__(self):
+		return len(self.image_paths)
+
+	def __getitem__(self, idx):
+		with open(os.path.join(self.original_path, self.image_paths[idx]), 'rb') as f:
+			image_data = cPickle.load(f)
+		return self.image_paths[idx], image_data
+
+def collate_posts(batch):
+	return batch
+
+def pad_image_sequence(embedded_image, pad_value=0.):
+	# the feature store keeps fixed (MAX_SEQUENCE_LEN, dim) rows, so longer sequences are truncated
+	embedded_image = embedded_image[:CONFIG.MAX_SEQUENCE_LEN]
+	if len(embedded_image) < CONFIG.MAX_SEQUENCE_LEN:
+		# pad sentence with 0 if sentence length is shorter than `max_sentence_len`
+		return np.pad(embedded_image,
+					((0, CONFIG.MAX_SEQUENCE_LEN - len(embedded_image)), (0,0)),
+					"constant",
+					constant_values=(pad_value))
+	return embedded_image
+
+def embedding_images(target_dataset, arch, gpu, batch_size=64, num_workers=4):
+	# images of consecutive posts are packed into batches of `batch_size` images,
+	# so one forward pass covers many posts instead of the 1~10 images of a single one.
 	dataset_path = os.path.join(CONFIG.DATASET_PATH, target_dataset)
 	device = torch.device(gpu)
 	print("Loading embedding model...")
@@ -115,32 +176,63 @@ def embedding_images(target_dataset, arch, gpu):
 	embedding_model.eval()
 	embedding_model.to(device)
 	print("Loading embedding model completed")
-	pad_value = 0.
 	embedding_path = os.path.join(dataset_path, arch)
-	if not os.path.exists(embedding_path):
-		os.mkdir(embedding_path)
+	feature_writer = ImageFeatureWriter(embedding_path, CONFIG.FEATURE_SHARD_SIZE)
 	original_path = os.path.join(CONFIG.DATA_PATH, 'dataset', target_dataset, 'original')
-	for image_path in tqdm(os.listdir(original_path)):
-		with open(os.path.join(original_path, image_path), 'rb') as f:
-			image_data = cPickle.load(f)
-		f.close()
-
-		image_data = torch.from_numpy(image_data).type(torch.FloatTensor).to(device)
-		embedded_image = embedding_model(image_data).detach().cpu().numpy()
-
-		if len(embedded_image) < CONFIG.MAX_SEQUENCE_LEN:
-			# pad sentence with 0 if sentence length is shorter than `max_sentence_len`
-			vector_array = np.lib.pad(embedded_image,
-									((0, CONFIG.MAX_SEQUENCE_LEN - len(embedded_image)), (0,0)),
-									"constant",
-									constant_values=(pad_value))
-		else:
-			vector_array = embedded_image
-		#vector_array = vector_array / np.linalg.norm(vector_array, axis=1, ord=2, keepdims=True)
-		with open(os.path.join(embedding_path, image_path), 'wb') as f:
-			cPickle.dump(vector_array, f)
-		f.close()
-		del image_data, embedded_image, vector_array
+	image_dataset = ImagePickleDataset(original_path)
+	image_loader = DataLoader(image_dataset, batch_size=max(1, batch_size // 4), num_workers=num_workers, collate_fn=collate_posts)
+
+	def embed(image_data):
+		with torch.no_grad():
+			image_data = torch.from_numpy(image_data).type(torch.FloatTensor).to(device)
+			return embedding_model(image_data).cpu().numpy()
+
+	post_queue = deque()
+	pending_images = []
+	pending_count = 0
+	embedded_images = []
+
+	def write_completed_posts():
+		nonlocal embedded_images
+		if len(embedded_images) == 0:
+			return
+		embedded_data = np.concatenate(embedded_images)
+		offset = 0
+		while len(post_queue) > 0 and offset + post_queue[0][1] <= len(embedded_data):
+			image_path, image_count = post_queue.popleft()
+			vector_array = pad_image_sequence(embedded_data[offset:offset + image_count])
+			offset = offset + image_count
+			#vector_array = vector_array / np.linalg.norm(vector_array, axis=1, ord=2, keepdims=True)
+			feature_writer.append(image_path[:-len('.p')], vector_array, min(image_count, CONFIG.MAX_SEQUENCE_LEN))
+		embedded_images = [embedded_data[offset:]]
+
+	for posts in tqdm(image_loader):
+		for image_path, image_data in posts:
+			post_queue.append((image_path, len(image_data)))
+			pending_images.append(image_data)
+			pending_count = pending_count + len(image_data)
+		while pending_count >= batch_size:
+			image_data = np.concatenate(pending_images)
+			embedded_images.append(embed(image_data[:batch_size]))
+			pending_images = [image_data[batch_size:]]
+			pending_count = pending_count - batch_size
+			write_completed_posts()
+	if pending_count > 0:
+		embedded_images.append(embed(np.concatenate(pending_images)))
+	write_completed_posts()
+	feature_writer.close()
+
+def convert_image_pickles(target_dataset, arch):
+	# pack the per-post pickles of older runs into the sharded feature store
+	embedding_path = os.path.join(CONFIG.DATASET_PATH, target_dataset, arch)
+	feature_writer = ImageFeatureWriter(embedding_path, CONFIG.FEATURE_SHARD_SIZE)
+	pickle_list = [image_path for image_path in os.listdir(embedding_path) if image_path.endswith('.p')]
+	for image_path in tqdm(pickle_list):
+		with open(os.path.join(embedding_path, image_path), 'rb') as f:
+			vector_array = cPickle.load(f)
+		image_count = int(np.count_nonzero(np.any(vector_array != 0, axis=1)))
+		feature_writer.append(image_path[:-len('.p')], pad_image_sequence(vector_array), min(image_count, CONFIG.MAX_SEQUENCE_LEN))
+	feature_writer.close()
 
 def embedding_text(target_dataset):
 	print("Loading embedding model...")
@@ -207,63 +299,58 @@ def process_dataset_images(target_dataset):
 			del image_data
 	pbar.close()
 
-def process_dataset_text(target_dataset):
+def process_dataset_text(target_dataset, num_workers=CONFIG.TOKENIZER_WORKERS, chunksize=100000):
+	# two passes over the crawl so memory does not grow with the number of posts:
+	# tokens are spilled to a temporary file while counting, then rewritten with UNK.
 	dataset_path = os.path.join(CONFIG.DATASET_PATH, target_dataset)
 	if not os.path.exists(dataset_path):
 		os.mkdir(dataset_path)
-	df_data = pd.read_csv(os.path.join(CONFIG.TARGET_PATH, 'posts.csv'), encoding='utf-8-sig')
-	print("tokenizing sentences...")
-	pbar = tqdm(total=df_data.shape[0])
-	shortcode_list = []
-	word_list_list = []
-	for index, in_row in df_data.iterrows():
-		pbar.update(1)
-		if pd.isna(in_row.iloc[2]):
-			continue
-		word_list = process_text(in_row.iloc[2])
-		if len(word_list) > 0:
-			shortcode_list.append(in_row.iloc[1])
-			word_list_list.append(word_list)
-	pbar.close()
-	print("counting frequencies...")
-	frequency = {}
-	pbar = tqdm(total=len(word_list_list))
-	for word_list in word_list_list:
-		pbar.update(1)
-		for word in word_list:
-			count = frequency.get(word, 0)
-			frequency[word] = count + 1
-	pbar.close()
-	print("convert too few words to UNK token...")
-	pbar = tqdm(total=len(word_list_list))
-	processed_word_list_list = []
-	for word_list in word_list_list:
-		pbar.update(1)
-		processed_word_list = []
-		for word in word_list:
-			if frequency[word] < CONFIG.MIN_WORD_COUNT:
-				processed_word_list.append('UNK')
-			else:
-				processed_word_list.append(word)
-		processed_word_list_list.append(processed_word_list)
+	token_path = os.path.join(dataset_path, 'tokens.tmp')
+	short_codes = deque()
+
+	def read_captions():
+		for df_chunk in pd.read_csv(os.path.join(CONFIG.TARGET_PATH, 'posts.csv'), encoding='utf-8-sig', chunksize=chunksize):
+			df_chunk = df_chunk[df_chunk.iloc[:, 2].notna()]
+			for short_code, caption in zip(df_chunk.iloc[:, 1], df_chunk.iloc[:, 2]):
+				short_codes.append(short_code)
+				yield caption
+
+	print("tokenizing sentences and counting frequencies...")
+	frequency = Counter()
+	pbar = tqdm()
+	with TokenCache(CONFIG.TOKEN_CACHE_PATH) as cache, open(token_path, 'w', encoding='utf-8') as f_token:
+		for word_list in iter_process_text(read_captions(), num_workers, CONFIG.TOKENIZER_CHUNKSIZE, cache):
+			pbar.update(1)
+			short_code = short_codes.popleft()
+			if len(word_list) > 0:
+				frequency.update(word_list)
+				f_token.write(short_code + '\t' + ' '.join(word_list) + '\n')
 	pbar.close()
-	print("making corpus and csv files...")
+	print("convert too few words to UNK token and making corpus and csv files...")
 	f_csv = open(os.path.join(dataset_path, 'posts.csv'), 'w', encoding='utf-8-sig')
 	f_corpus = open(os.path.join(dataset_path, 'corpus.txt'), 'w', encoding='utf-8')
 	wr = csv.writer(f_csv)
-	pbar = tqdm(total=len(processed_word_list_list))
-	for index in range(len(processed_word_list_list)):
-		pbar.update(1)
-		sentence = ' '.join(processed_word_list_list[index])
-		if len(sentence) > 0:
+	pbar = tqdm()
+	with open(token_path, 'r', encoding='utf-8', newline='\n') as f_token:
+		for line in f_token:
+			pbar.update(1)
+			short_code, sentence = line.rstrip('\n').split('\t')
+			processed_word_list = []
+			for word in sentence.split():
+				if frequency[word] < CONFIG.MIN_WORD_COUNT:
+					processed_word_list.append('UNK')
+				else:
+					processed_word_list.append(word)
+			sentence = ' '.join(processed_word_list)
 			out_row = []
-			out_row.append(shortcode_list[index])
+			out_row.append(short_code)
 			out_row.append(sentence + ' <EOS>')
 			wr.writerow(out_row)
 			f_corpus.write(sentence + ' <EOS>\n')
 	pbar.close()
 	f_csv.close()
 	f_corpus.close()
+	os.remove(token_path)
 
 def test(target_dataset):
 	# toy_path = os.path.join(CONFIG.DATASET_PATH, 'instagram0830')
@@ -302,23 +389,18 @@ def test(target_dataset):
 	print("tokenizing sentences...")
 	shortcode_list = []
 	word_list_list = []
-	pbar = tqdm(total=len(dataset[0]))
-	for pg in dataset[0]:
-		pbar.update(1)
-		data = " ".join([dataset[3][idx] for idx in pg])
-		data = data.replace("END_TOKEN", "")
-		word_list = process_text(data)
-		if len(word_list) > 0:
-			word_list_list.append(word_list)
-	pbar.close()
-	pbar = tqdm(total=len(dataset[1]))
-	for pg in dataset[1]:
-		pbar.update(1)
-		data = " ".join([dataset[3][idx] for idx in pg])
-		data = data.replace("END_TOKEN", "")
-		word_list = process_text(data)
-		if len(word_list) > 0:
-			word_list_list.append(word_list)
+	text_list = []
+	for split in (dataset[0], dataset[1]):
+		for pg in split:
+			data = " ".join([dataset[3][idx] for idx in pg])
+			data = data.replace("END_TOKEN", "")
+			text_list.append(data)
+	pbar = tqdm(total=len(text_list))
+	with TokenCache(CONFIG.TOKEN_CACHE_PATH) as cache:
+		for word_list in iter_process_text(text_list, CONFIG.TOKENIZER_WORKERS, CONFIG.TOKENIZER_CHUNKSIZE, cache):
+			pbar.update(1)
+			if len(word_list) > 0:
+				word_list_list.append(word_list)
 	pbar.close()
 	print("making corpus and csv files...")
 	f_csv = open(os.path.join(dataset_path, 'posts.csv'), 'w', encoding='utf-8')
@@ -346,28 +428,37 @@ def make_toy_dataset(target_dataset):
 		short_codes.append(row)
 	toy_codes = random.sample(short_codes, k=500)
 
+	image_store = ImageFeatureStore(os.path.join(dataset_path, 'resnet152'))
+	feature_writer = ImageFeatureWriter(os.path.join(toy_path, 'resnet152'), CONFIG.FEATURE_SHARD_SIZE)
 	f_csv = open(os.path.join(toy_path, 'posts.csv'), 'w', encoding='utf-8')
 	wr = csv.writer(f_csv)
 	for row in toy_codes:
 		wr.writerow(row)
-		short_code = row.iloc[0] + '.p'
-		shutil.copy2(os.path.join(dataset_path, 'resnet152', short_code), os.path.join(toy_path, 'resnet152', short_code))
+		image_row = image_store.get_rows([row.iloc[0]])[0]
+		if image_row >= 0:
+			feature_writer.append(row.iloc[0], image_store.features[image_row], image_store.counts[image_row])
+	f_csv.close()
+	feature_writer.close()
 	
 def run(option): 
 	if option == 0:
 		copy_selected_post(target_folder=sys.argv[2])
 	elif option == 1:
-		embedding_images(target_dataset=sys.argv[2], arch=sys.argv[3], gpu=sys.argv[4])
+		embedding_images(target_dataset=sys.argv[2], arch=sys.argv[3], gpu=sys.argv[4], batch_size=int(sys.argv[5]) if len(sys.argv) > 5 else 64, num_workers=int(sys.argv[6]) if len(sys.argv) > 6 else 4)
 	elif option == 2:
 		embedding_text(target_dataset=sys.argv[2])
 	elif option == 3:
 		process_dataset_images(target_dataset=sys.argv[2])
 	elif option == 4:
-		process_dataset_text(target_dataset=sys.argv[2])
+		process_dataset_text(target_dataset=sys.argv[2], num_workers=int(sys.argv[3]) if len(sys.argv) > 3 else CONFIG.TOKENIZER_WORKERS)
 	elif option == 5:
 		test(target_dataset=sys.argv[2])
 	elif option == 6:
 		make_toy_dataset(target_dataset=sys.argv[2])
+	elif option == 7:
+		convert_image_pickles(target_dataset=sys.argv[2], arch=sys.argv[3])
+	elif option == 8:
+		make_post_meta(target_dataset=sys.argv[2])
 	else:
 		print("This option does not exist!\n")
 
@@ -20,6 +20,9 @@ from tqdm import tqdm
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
 from torch.autograd import Variable
 from torch.optim.adam import Adam
@@ -50,10 +53,12 @@ def main():
 	parser.add_argument('-log_interval', type=int, default=25600,
 						help='how many steps to wait before logging training status')
 	parser.add_argument('-tau', type=float, default=0.01, help='temperature parameter')
+	parser.add_argument('-num_sampled', type=int, default=0, help='negative words of the sampled softmax in training, 0 for the full softmax')
 	# data
 	parser.add_argument('-target_dataset', type=str, default=None, help='folder name of target dataset')
 	parser.add_argument('-shuffle', default=True, help='shuffle data every epoch')
 	parser.add_argument('-split_rate', type=float, default=0.9, help='split rate between train and validation')
+	parser.add_argument('-buckets', type=str, default=None, help='comma separated sentence lengths to bucket captions by, defaults to the buckets of -text_pt')
 	# model
 	parser.add_argument('-latent_size', type=int, default=900, help='size of latent variable')
 	parser.add_argument('-filter_size', type=int, default=300, help='filter size of convolution')
@@ -68,6 +73,8 @@ def main():
 	# train
 	parser.add_argument('-noti', action='store_true', default=False, help='whether using gpu server')
 	parser.add_argument('-gpu', type=str, default='cuda', help='gpu number')
+	parser.add_argument('-world_size', type=int, default=1, help='local processes training with DistributedDataParallel on cpu, 1 trains in this process on -gpu')
+	parser.add_argument('-master_port', type=int, default=29500, help='port the processes of distributed training meet on')
 	# option
 	parser.add_argument('-resume', type=str, default=None, help='filename of checkpoint to resume ')
 
@@ -75,38 +82,45 @@ def main():
 
 	if args.noti:
 		slacknoti("underkoo start using")
-	train_reconstruction(args)
+	if args.world_size > 1:
+		# every process draws the same train/validation split from this seed
+		args.seed = int(np.random.randint(2 ** 31))
+		mp.spawn(train_reconstruction, args=(args,), nprocs=args.world_size)
+	else:
+		train_reconstruction(0, args)
 	if args.noti:
 		slacknoti("underkoo end using")
 
 
 
-def train_reconstruction(args):
-	device = torch.device(args.gpu)
-	print("Loading embedding model...")
-	with open(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'word_embedding.p'), "rb") as f:
-		text_embedding_model = cPickle.load(f)
-	with open(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'word_idx.json'), "r", encoding='utf-8') as f:
-		word_idx = json.load(f)
-	print("Loading embedding model completed")
-	print("Loading dataset...")
-	train_dataset, val_dataset = load_multimodal_data(args, CONFIG, word2idx=word_idx[1])
-	print("Loading dataset completed")
-	train_loader, val_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=args.shuffle),\
-								  DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False)
+def train_reconstruction(rank, args):
+	if args.world_size > 1:
+		util.init_distributed(rank, args.world_size, args.master_port)
+		torch.manual_seed(args.seed)
+		device = torch.device('cpu')
+	else:
+		device = torch.device(args.gpu)
+	with util.main_process_first():
+		print("Loading embedding model...")
+		text_embedding_model = util.load_embedding_matrix(CONFIG, args.target_dataset)
+		vocab = util.Vocabulary.load(os.path.join(CONFIG.DATASET_PATH, args.target_dataset))
+		print("Loading embedding model completed")
+		print("Loading dataset...")
+		train_dataset, val_dataset = load_multimodal_data(args, CONFIG, vocab=vocab)
+		print("Loading dataset completed")
 
 	# t1 = max_sentence_len + 2 * (args.filter_shape - 1)
 	t1 = CONFIG.MAX_SENTENCE_LEN
 	t2 = int(math.floor((t1 - args.filter_shape) / 2) + 1) # "2" means stride size
 	t3 = int(math.floor((t2 - args.filter_shape) / 2) + 1)
 	args.t3 = t3
-	text_embedding = nn.Embedding.from_pretrained(torch.FloatTensor(text_embedding_model))
+	text_embedding = nn.Embedding.from_pretrained(text_embedding_model)
 	text_encoder = text_model.ConvolutionEncoder(text_embedding, t3, args.filter_size, args.filter_shape, args.latent_size)
-	text_decoder = text_model.DeconvolutionDecoder(text_embedding, args.tau, t3, args.filter_size, args.filter_shape, args.latent_size, device)
+	text_decoder = text_model.DeconvolutionDecoder(text_embedding, args.tau, t3, args.filter_size, args.filter_shape, args.latent_size, device, args.num_sampled)
 	if args.text_pt:
 		text_checkpoint = torch.load(os.path.join(CONFIG.CHECKPOINT_PATH, args.text_pt), map_location=lambda storage, loc: storage)
-		text_encoder.load_state_dict(text_checkpoint['text_encoder'])
-		text_decoder.load_state_dict(text_checkpoint['text_decoder'])
+		util.load_weights(text_encoder, text_checkpoint['text_encoder'])
+		util.load_weights(text_decoder, text_checkpoint['text_decoder'])
 	imgseq_encoder = imgseq_model.RNNEncoder(args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
 	imgseq_decoder = imgseq_model.RNNDecoder(CONFIG.MAX_SEQUENCE_LEN, args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
 	if args.imgseq_pt:
@@ -120,53 +134,87 @@ def train_reconstruction(args):
 		print("Restart from checkpoint")
 		checkpoint = torch.load(os.path.join(CONFIG.CHECKPOINT_PATH, args.resume), map_location=lambda storage, loc: storage)
 		start_epoch = checkpoint['epoch']
-		multimodal_encoder.load_state_dict(checkpoint['multimodal_encoder'])
-		multimodal_decoder.load_state_dict(checkpoint['multimodal_decoder'])
+		util.load_weights(multimodal_encoder, checkpoint['multimodal_encoder'])
+		util.load_weights(multimodal_decoder, checkpoint['multimodal_decoder'])
 	else:		
 		print("Start from initial")
 		start_epoch = 0
+
+	# captions keep the buckets the text encoder was trained with, so its latents are made the same way at inference
+	buckets = None
+	if args.buckets:
+		buckets = text_model.make_buckets(args.buckets, args.filter_shape, CONFIG.MAX_SENTENCE_LEN)
+	elif args.resume:
+		buckets = checkpoint.get('buckets')
+	elif args.text_pt:
+		buckets = text_checkpoint.get('buckets')
+	if buckets:
+		print("Sentence length buckets: ", buckets)
+		pad_idx = vocab['<PAD>']
+		train_loader, val_loader = util.get_bucket_loader(train_dataset, args.batch_size, args.shuffle, buckets, pad_idx, rank, args.world_size),\
+									  util.get_bucket_loader(val_dataset, args.batch_size, False, buckets, pad_idx, rank, args.world_size, even_shards=False)
+	else:
+		train_loader, val_loader = util.get_batch_loader(train_dataset, args.batch_size, args.shuffle, rank=rank, world_size=args.world_size),\
+									  util.get_batch_loader(val_dataset, args.batch_size, False, rank=rank, world_size=args.world_size, even_shards=False)
 	
 	multimodal_autoencoder = multimodal_model.MultimodalAutoEncoder(multimodal_encoder, multimodal_decoder)
 	text_criterion = nn.NLLLoss().to(device)
-	imgseq_criterion = nn.MSELoss().to(device)
+	imgseq_criterion = imgseq_model.MaskedMSELoss().to(device)
 	multimodal_autoencoder.to(device)
+	if args.world_size > 1:
+		# dropout and negative samples differ between the processes
+		torch.manual_seed(args.seed + rank)
+		util.ignore_frozen_embedding(multimodal_autoencoder)
+		# buffers are not broadcast every step, batch norm statistics are averaged every epoch instead
+		train_autoencoder = DistributedDataParallel(multimodal_autoencoder, broadcast_buffers=False)
+	else:
+		train_autoencoder = multimodal_autoencoder
 
 	optimizer = AdamW(multimodal_autoencoder.parameters(), lr=1., weight_decay=args.weight_decay, amsgrad=True)
+	# len(train_loader) counts the batches of one process, so a half cycle stays `half_cycle_interval` epochs at any world size
 	step_size = args.half_cycle_interval*len(train_loader)
 	clr = cyclical_lr(step_size, min_lr=args.lr, max_lr=args.lr*args.lr_factor)
 	scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, [clr])
 	if args.resume:
 		optimizer.load_state_dict(checkpoint['optimizer'])
 		scheduler.load_state_dict(checkpoint['scheduler'])
-	exp = Experiment("Multimodal autoencoder", capture_io=False)
-
-	for arg, value in vars(args).items():
-		exp.param(arg, value) 
+	exp = None
+	if rank == 0:
+		exp = Experiment("Multimodal autoencoder", capture_io=False)
+		for arg, value in vars(args).items():
+			exp.param(arg, value) 
 	try:
 		multimodal_autoencoder.train() 
 
 		for epoch in range(start_epoch, args.epochs):
 			print("Epoch: {}".format(epoch))
-			for steps, (text_batch, imgseq_batch) in enumerate(train_loader):
+			util.set_loader_epoch(train_loader, epoch)
+			for steps, (text_batch, imgseq_batch, imgseq_len) in enumerate(train_loader):
 				torch.cuda.empty_cache()
 				text_feature = Variable(text_batch).to(device)
 				imgseq_feature = Variable(imgseq_batch).to(device)
 				optimizer.zero_grad()
-				text_prob, imgseq_feature_hat = multimodal_autoencoder(text_feature, imgseq_feature)
-				text_loss = text_criterion(text_prob.transpose(1, 2), text_feature)
-				imgseq_loss = imgseq_criterion(imgseq_feature_hat, imgseq_feature)
+				if args.num_sampled > 0:
+					text_prob, text_target, candidates, imgseq_feature_hat = train_autoencoder(text_feature, imgseq_feature, imgseq_len, sampled=True)
+				else:
+					text_prob, imgseq_feature_hat = train_autoencoder(text_feature, imgseq_feature, imgseq_len)
+					text_target, candidates = text_feature, None
+				text_loss = text_criterion(text_prob.transpose(1, 2), text_target)
+				imgseq_loss = imgseq_criterion(imgseq_feature_hat, imgseq_feature, imgseq_len)
 				loss = text_loss + imgseq_loss
 				del text_loss, imgseq_loss
 				loss.backward()
 				optimizer.step()
 				scheduler.step()
 
-				if (steps * args.batch_size) % args.log_interval == 0:					
+				if rank == 0 and (steps * args.batch_size) % args.log_interval == 0:					
 					input_data = text_feature[0]
 					single_data = text_prob[0]
 					_, predict_index = torch.max(single_data, 1)
-					input_sentence = util.transform_idx2word(input_data.detach().cpu().numpy(), idx2word=word_idx[0])
-					predict_sentence = util.transform_idx2word(predict_index.detach().cpu().numpy(), idx2word=word_idx[0])	
+					if candidates is not None:
+						predict_index = candidates[predict_index]
+					input_sentence = util.transform_idx2word(input_data.detach().cpu().numpy(), idx2word=vocab.idx2word)
+					predict_sentence = util.transform_idx2word(predict_index.detach().cpu().numpy(), idx2word=vocab.idx2word)	
 					print("Epoch: {} at {} lr: {}".format(epoch, str(datetime.datetime.now()), str(scheduler.get_lr())))
 					print("Steps: {}".format(steps))
 					print("Loss: {}".format(loss.detach().item()))
@@ -175,10 +223,13 @@ def train_reconstruction(args):
 					print("Output Sentence:")
 					print(predict_sentence)
 					del input_data, single_data, _, predict_index
-				del text_feature, text_prob, imgseq_feature, imgseq_feature_hat, loss
+				del text_feature, text_prob, text_target, candidates, imgseq_feature, imgseq_feature_hat, loss
 			
+			util.average_buffers(multimodal_autoencoder)
+			_avg_loss, _rouge_1, _rouge_2 = eval_reconstruction_with_rouge(multimodal_autoencoder, vocab, text_criterion, imgseq_criterion, val_loader, device)
+			if rank != 0:
+				continue
 			exp.log("\nEpoch: {} at {} lr: {}".format(epoch, str(datetime.datetime.now()), str(scheduler.get_lr())))
-			_avg_loss, _rouge_1, _rouge_2 = eval_reconstruction_with_rouge(multimodal_autoencoder, word_idx[0], text_criterion, imgseq_criterion, val_loader, device)
 			exp.log("\nEvaluation - loss: {}  Rouge1: {} Rouge2: {}".format(_avg_loss, _rouge_1, _rouge_2))
 
 			util.save_models({
@@ -188,6 +239,8 @@ def train_reconstruction(args):
 				'avg_loss': _avg_loss,
 				'Rouge1:': _rouge_1,
 				'Rouge2': _rouge_2,
+				'packed_sequences': True,
+				'buckets': buckets,
 				'optimizer' : optimizer.state_dict(),
 				'scheduler' : scheduler.state_dict()
 			}, CONFIG.CHECKPOINT_PATH, "multimodal_autoencoder")
@@ -195,34 +248,39 @@ def train_reconstruction(args):
 		print("Finish!!!")
 
 	finally:
-		exp.end()
+		if exp is not None:
+			exp.end()
+		if args.world_size > 1:
+			dist.destroy_process_group()
 
-def eval_reconstruction_with_rouge(autoencoder, idx2word, text_criterion, imgseq_criterion, data_iter, device):
+def eval_reconstruction_with_rouge(autoencoder, vocab, text_criterion, imgseq_criterion, data_iter, device):
 	print("=================Eval======================")
 	autoencoder.eval()
 	step = 0
 	avg_loss = 0.
 	rouge_1 = 0.
 	rouge_2 = 0.
-	for text_batch, imgseq_batch in tqdm(data_iter):
+	for text_batch, imgseq_batch, imgseq_len in tqdm(data_iter, disable=not util.is_main_process()):
 		torch.cuda.empty_cache()
 		with torch.no_grad():
 			text_feature = Variable(text_batch).to(device)
 			imgseq_feature = Variable(imgseq_batch).to(device)
-		text_prob, imgseq_feature_hat = autoencoder(text_feature, imgseq_feature)
+		text_prob, imgseq_feature_hat = autoencoder(text_feature, imgseq_feature, imgseq_len)
 		_, predict_index = torch.max(text_prob, 2)
-		original_sentences = [util.transform_idx2word(sentence, idx2word=idx2word) for sentence in text_feature.detach().cpu().numpy()]		
-		predict_sentences = [util.transform_idx2word(sentence, idx2word=idx2word) for sentence in predict_index.detach().cpu().numpy()]	
+		original_sentences = vocab.decode(text_feature.detach().cpu().numpy())		
+		predict_sentences = vocab.decode(predict_index.detach().cpu().numpy())	
 		r1, r2 = calc_rouge(original_sentences, predict_sentences)		
 		rouge_1 += r1 / len(text_batch)
 		rouge_2 += r2 / len(text_batch)
 		text_loss = text_criterion(text_prob.transpose(1, 2), text_feature)
-		imgseq_loss = imgseq_criterion(imgseq_feature_hat, imgseq_feature)
+		imgseq_loss = imgseq_criterion(imgseq_feature_hat, imgseq_feature, imgseq_len)
 		loss = text_loss + imgseq_loss
 		del text_loss, imgseq_loss
 		avg_loss += loss.detach().item()
 		step = step + 1
 		del text_feature, text_prob, imgseq_feature, imgseq_feature_hat, loss, _, predict_index
+	# every process evaluated its own shard of the validation data
+	avg_loss, rouge_1, rouge_2, step = util.all_reduce_sum([avg_loss, rouge_1, rouge_2, step])
 	avg_loss = avg_loss / step
 	rouge_1 = rouge_1 / step
 	rouge_2 = rouge_2 / step
@@ -7,6 +7,8 @@ import datetime
 import os
 import csv
 import math
+import time
+import copy
 import numpy as np
 import pandas as pd
 import _pickle as cPickle
@@ -27,7 +29,7 @@ from torch.optim.adam import Adam
 from torch.optim.lr_scheduler import StepLR, CyclicLR
 from model import util
 from model import text_model, imgseq_model, multimodal_model
-from model.util import load_fullmultimodal_data
+from model.util import load_fullmultimodal_data, load_multimodal_data
 
 
 CONFIG = config.Config
@@ -60,63 +62,208 @@ def main():
 	parser.add_argument('-gpu', type=str, default='cuda', help='gpu number')
 	# option
 	parser.add_argument('-checkpoint', type=str, default=None, help='filename of checkpoint to resume ')
+	parser.add_argument('-latent_dtype', type=str, default='float32', choices=['float32', 'float16'], help='dtype of the saved latents')
+	parser.add_argument('-csv', action='store_true', default=False, help='also export the latents as csv')
+	parser.add_argument('-incremental', action='store_true', default=False, help='only encode posts without an up-to-date latent')
+	# backend
+	parser.add_argument('-backend', type=str, default='eager', choices=['eager', 'torchscript'], help='how the encoder is run')
+	parser.add_argument('-scripted_model', type=str, default=None, help='filename of the torchscript encoder in the checkpoint folder')
+	parser.add_argument('-export', action='store_true', default=False, help='export the checkpoint as a torchscript encoder instead of extracting latents')
+	parser.add_argument('-benchmark_batches', type=int, default=20, help='batches compared between eager and torchscript on export')
+	parser.add_argument('-num_threads', type=int, default=None, help='cpu threads of torch')
+	parser.add_argument('-quantize', action='store_true', default=False, help='int8 dynamic quantization of the LSTM and Linear layers (cpu only)')
+	parser.add_argument('-min_cosine', type=float, default=0.99, help='lowest mean cosine to fp32 a quantized export may have')
+	parser.add_argument('-drift_report', action='store_true', default=False, help='report the latent drift of the quantized encoder on the validation split')
+	parser.add_argument('-drift_samples', type=int, default=10000, help='validation posts used by the drift report')
 
 	args = parser.parse_args()
 
+	if args.num_threads is not None:
+		torch.set_num_threads(args.num_threads)
 	if args.noti:
 		slacknoti("underkoo start using")
-	get_latent(args)
+	if args.export:
+		export_encoder(args)
+	elif args.drift_report:
+		report_quantization_drift(args)
+	else:
+		get_latent(args)
 	if args.noti:
 		slacknoti("underkoo end using")
 
 
 
-def get_latent(args):
-	device = torch.device(args.gpu)
-	print("Loading embedding model...")
-	with open(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'word_embedding.p'), "rb") as f:
-		text_embedding_model = cPickle.load(f)
-	with open(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'word_idx.json'), "r", encoding='utf-8') as f:
-		word_idx = json.load(f)
-	print("Loading embedding model completed")
-	print("Loading dataset...")
-	full_dataset = load_fullmultimodal_data(args, CONFIG, word2idx=word_idx[1])
-	print("Loading dataset completed")
-	full_loader = DataLoader(full_dataset, batch_size=args.batch_size, shuffle=False)
-	
+def load_eager_encoder(args, device):
+	text_embedding_model = util.load_embedding_matrix(CONFIG, args.target_dataset)
 	# t1 = max_sentence_len + 2 * (args.filter_shape - 1)
 	t1 = CONFIG.MAX_SENTENCE_LEN
 	t2 = int(math.floor((t1 - args.filter_shape) / 2) + 1) # "2" means stride size
 	t3 = int(math.floor((t2 - args.filter_shape) / 2) + 1)
 	args.t3 = t3
 
-	text_embedding = nn.Embedding.from_pretrained(torch.FloatTensor(text_embedding_model))
+	text_embedding = nn.Embedding.from_pretrained(text_embedding_model)
 	text_encoder = text_model.ConvolutionEncoder(text_embedding, t3, args.filter_size, args.filter_shape, args.latent_size)
-	text_decoder = text_model.DeconvolutionDecoder(text_embedding, args.tau, t3, args.filter_size, args.filter_shape, args.latent_size, device)
 	imgseq_encoder = imgseq_model.RNNEncoder(args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
-	imgseq_decoder = imgseq_model.RNNDecoder(CONFIG.MAX_SEQUENCE_LEN, args.image_embedding_dim, args.num_layer, args.latent_size, bidirectional=True)
 	multimodal_encoder = multimodal_model.MultimodalEncoder(text_encoder, imgseq_encoder, args.latent_size)
 	checkpoint = torch.load(os.path.join(CONFIG.CHECKPOINT_PATH, args.checkpoint), map_location=lambda storage, loc: storage)
-	multimodal_encoder.load_state_dict(checkpoint['multimodal_encoder'])
+	util.load_weights(multimodal_encoder, checkpoint['multimodal_encoder'])
+	# checkpoints trained before packed sequences read the padded image sequences
+	args.packed_sequences = checkpoint.get('packed_sequences', False)
+	# captions of a bucketed checkpoint are encoded at the length of their bucket
+	args.buckets = checkpoint.get('buckets')
+	if args.buckets:
+		vocab = util.Vocabulary.load(os.path.join(CONFIG.DATASET_PATH, args.target_dataset))
+		multimodal_encoder = multimodal_model.BucketedEncoder(multimodal_encoder, args.buckets, vocab['<PAD>'])
 	multimodal_encoder.to(device)
-	multimodal_encoder.eval() 
+	multimodal_encoder.eval()
+	return multimodal_encoder
+
+def get_inputs(args, text_batch, imgseq_batch, imgseq_len, device):
+	if args.packed_sequences:
+		return text_batch.to(device), imgseq_batch.to(device), imgseq_len
+	return text_batch.to(device), imgseq_batch.to(device)
+
+def make_inference_encoder(multimodal_encoder, quantize):
+	inference_encoder = copy.deepcopy(multimodal_encoder)
+	# the folded text encoder only runs full-length captions
+	if not isinstance(inference_encoder, multimodal_model.BucketedEncoder):
+		inference_encoder.text_encoder = text_model.FoldedConvolutionEncoder(multimodal_encoder.text_encoder)
+	if quantize:
+		inference_encoder = multimodal_model.quantize_encoder(inference_encoder)
+	return inference_encoder
+
+def get_checkpoint_hash(args):
+	# quantized latents are not the fp32 ones, so they are keyed apart in the latent manifest
+	return util.file_hash(os.path.join(CONFIG.CHECKPOINT_PATH, args.checkpoint), b'int8' if args.quantize else b'')
+
+def load_multimodal_encoder(args, device):
+	# the encoder and the hash of the training checkpoint it comes from
+	if args.backend == 'torchscript':
+		extra_files = {'checkpoint_hash': '', 'packed_sequences': ''}
+		multimodal_encoder = torch.jit.load(os.path.join(CONFIG.CHECKPOINT_PATH, args.scripted_model), map_location=device, _extra_files=extra_files)
+		args.packed_sequences = extra_files['packed_sequences'] == b'1'
+		return multimodal_encoder, np.uint64(extra_files['checkpoint_hash'])
+	multimodal_encoder = load_eager_encoder(args, device)
+	if args.quantize:
+		multimodal_encoder = make_inference_encoder(multimodal_encoder, True)
+	return multimodal_encoder, get_checkpoint_hash(args)
+
+def compare_encoders(reference_encoder, encoder, batches):
+	# max abs difference, per-post cosine to the reference and the time both took
+	max_diff = 0.
+	cosines = []
+	reference_time = 0.
+	encoder_time = 0.
+	with torch.no_grad():
+		# the first runs of a scripted module compile and optimize its graph
+		for _ in range(3):
+			encoder(*batches[0])
+		for batch in batches:
+			start = time.time()
+			reference_h = reference_encoder(*batch)
+			reference_time += time.time() - start
+			start = time.time()
+			h = encoder(*batch)
+			encoder_time += time.time() - start
+			max_diff = max(max_diff, (reference_h - h).abs().max().item())
+			cosines.append(F.cosine_similarity(reference_h, h, dim=1).cpu().numpy())
+	return max_diff, np.concatenate(cosines), reference_time, encoder_time
+
+def export_encoder(args):
+	# traces the encoder with the folded text encoder on real batches, freezes it with
+	# its weights and checks it against eager mode before it is saved
+	device = torch.device(args.gpu)
+	vocab = util.Vocabulary.load(os.path.join(CONFIG.DATASET_PATH, args.target_dataset))
+	full_dataset = load_fullmultimodal_data(args, CONFIG, vocab=vocab)
+	full_loader = util.get_batch_loader(full_dataset, args.batch_size, False)
+	multimodal_encoder = load_eager_encoder(args, device)
+	if args.buckets:
+		# a trace would keep the buckets of the batch it was traced on
+		raise RuntimeError("bucketed checkpoints cannot be exported to torchscript, use -backend eager")
+
+	batches = []
+	for text_batch, imgseq_batch, imgseq_len, _ in full_loader:
+		batches.append(get_inputs(args, text_batch, imgseq_batch, imgseq_len, device))
+		if len(batches) == args.benchmark_batches:
+			break
+	inference_encoder = make_inference_encoder(multimodal_encoder, args.quantize)
+	with torch.no_grad():
+		scripted_encoder = torch.jit.freeze(torch.jit.trace(inference_encoder, batches[0]))
+
+	max_diff, cosines, eager_time, scripted_time = compare_encoders(multimodal_encoder, scripted_encoder, batches)
+	print("Parity: max abs difference {:.2e}, mean cosine {:.6f} over {} batches".format(max_diff, cosines.mean(), len(batches)))
+	if args.quantize:
+		if cosines.mean() < args.min_cosine:
+			raise RuntimeError("quantized encoder drifts further from fp32 than -min_cosine")
+	elif max_diff > 1e-4:
+		raise RuntimeError("torchscript encoder does not match the eager encoder")
+	print("eager: {:.2f}ms torchscript: {:.2f}ms per batch of {}, speedup {:.2f}x".format(
+		eager_time * 1000 / len(batches), scripted_time * 1000 / len(batches), args.batch_size, eager_time / scripted_time))
+
+	suffix = '_encoder_int8.torchscript.pt' if args.quantize else '_encoder.torchscript.pt'
+	scripted_path = os.path.join(CONFIG.CHECKPOINT_PATH, os.path.splitext(args.checkpoint)[0] + suffix)
+	torch.jit.save(scripted_encoder, scripted_path, _extra_files={'checkpoint_hash': str(get_checkpoint_hash(args)), 'packed_sequences': str(int(args.packed_sequences))})
+	print("Saved ", scripted_path)
+
+def report_quantization_drift(args):
+	# cosine drift and throughput of the int8 encoder against fp32 on posts the model did not train on
+	device = torch.device('cpu')
+	vocab = util.Vocabulary.load(os.path.join(CONFIG.DATASET_PATH, args.target_dataset))
+	_, val_dataset = load_multimodal_data(args, CONFIG, vocab=vocab)
+	val_loader = util.get_batch_loader(val_dataset, args.batch_size, False)
+	multimodal_encoder = load_eager_encoder(args, device)
+	quantized_encoder = make_inference_encoder(multimodal_encoder, True)
+
+	batches = []
+	for text_batch, imgseq_batch, imgseq_len in val_loader:
+		batches.append(get_inputs(args, text_batch, imgseq_batch, imgseq_len, device))
+		if len(batches) * args.batch_size >= args.drift_samples:
+			break
+	n_posts = sum([len(batch[0]) for batch in batches])
+	max_diff, cosines, fp32_time, int8_time = compare_encoders(multimodal_encoder, quantized_encoder, batches)
+	print("Latent drift of int8 against fp32 over {} validation posts".format(n_posts))
+	print("cosine mean {:.6f} p1 {:.6f} min {:.6f}, max abs difference {:.4f}".format(
+		cosines.mean(), np.percentile(cosines, 1), cosines.min(), max_diff))
+	print("fp32: {:.1f} posts/s int8: {:.1f} posts/s, speedup {:.2f}x".format(
+		n_posts / fp32_time, n_posts / int8_time, fp32_time / int8_time))
+
+def get_latent(args):
+	device = torch.device(args.gpu)
+	print("Loading embedding model...")
+	vocab = util.Vocabulary.load(os.path.join(CONFIG.DATASET_PATH, args.target_dataset))
+	multimodal_encoder, checkpoint_hash = load_multimodal_encoder(args, device)
+	print("Loading embedding model completed")
+	print("Loading dataset...")
+	full_dataset = load_fullmultimodal_data(args, CONFIG, vocab=vocab)
+	print("Loading dataset completed")
 
-	f_csv = open(os.path.join(CONFIG.CSV_PATH, 'latent_' + args.target_dataset + '.csv'), 'w', encoding='utf-8-sig')
-	wr = csv.writer(f_csv)
-	for text_batch, imgseq_batch, short_code in tqdm(full_loader):
+	latent_path = os.path.join(CONFIG.LATENT_PATH, args.target_dataset)
+	latent_writer = util.LatentWriter(latent_path, CONFIG.LATENT_SHARD_SIZE, np.dtype(args.latent_dtype), append=args.incremental)
+	inputs = util.input_hashes(full_dataset)
+	stale = latent_writer.get_stale(full_dataset.short_codes, checkpoint_hash, inputs)
+	print("Posts to encode: {} of {}".format(stale.sum(), len(stale)))
+	full_dataset = util.FullMultimodalDataset(full_dataset.data[stale], CONFIG, full_dataset.text_data, full_dataset.image_store, full_dataset.short_codes[stale])
+	inputs = inputs[stale]
+	full_loader = util.get_batch_loader(full_dataset, args.batch_size, False)
+	offset = 0
+	for text_batch, imgseq_batch, imgseq_len, short_code in tqdm(full_loader):
 		torch.cuda.empty_cache()
 		with torch.no_grad():	
-			text_feature = Variable(text_batch).to(device)
-			imgseq_feature = Variable(imgseq_batch).to(device)
-		h = multimodal_encoder(text_feature, imgseq_feature)
-
-		for _short_code, _h in zip(short_code, h):
-			row = [_short_code] + _h.detach().cpu().numpy().tolist()
-			wr.writerow(row)
-		del text_feature, imgseq_feature
-	f_csv.close()
+			batch = get_inputs(args, text_batch, imgseq_batch, imgseq_len, device)
+			h = multimodal_encoder(*batch)
+		latent_writer.append(short_code, h.cpu().numpy(), checkpoint_hash, inputs[offset:offset + len(short_code)])
+		offset = offset + len(short_code)
+		del batch, h
+	latent_writer.close()
+	if args.csv:
+		export_latent_csv(latent_path, os.path.join(CONFIG.CSV_PATH, 'latent_' + args.target_dataset + '.csv'))
 	print("Finish!!!")
 
+def export_latent_csv(latent_path, csv_path):
+	latent_store = util.LatentStore(latent_path)
+	with open(csv_path, 'w', encoding='utf-8-sig') as f_csv:
+		for short_codes, latents in tqdm(latent_store.iter_shards()):
+			pd.DataFrame(latents, index=short_codes).to_csv(f_csv, header=False)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,70 @@
+import argparse
+import config
+import os
+import time
+import numpy as np
+
+from model.latent_index import LatentIndex, exact_search
+
+
+CONFIG = config.Config
+
+def main():
+	parser = argparse.ArgumentParser(description='approximate nearest neighbour index over post latents')
+	parser.add_argument('-target_dataset', type=str, default=None, help='folder name of target dataset')
+	parser.add_argument('-mode', type=str, default='build', choices=['build', 'query', 'benchmark'], help='what to do with the index')
+	# index
+	parser.add_argument('-n_trees', type=int, default=50, help='number of trees of the index')
+	parser.add_argument('-metric', type=str, default='angular', choices=['angular', 'euclidean'], help='distance of the index')
+	parser.add_argument('-search_k', type=int, default=-1, help='nodes to inspect per query, -1 means n_trees * k')
+	# query
+	parser.add_argument('-shortcode', type=str, default=None, help='comma separated shortcodes to query')
+	parser.add_argument('-k', type=int, default=10, help='number of neighbours')
+	# benchmark
+	parser.add_argument('-num_queries', type=int, default=1000, help='number of random queries of the benchmark')
+
+	args = parser.parse_args()
+
+	latent_path = os.path.join(CONFIG.LATENT_PATH, args.target_dataset)
+	if args.mode == 'build':
+		start = time.time()
+		latent_index = LatentIndex.build(latent_path, args.n_trees, args.metric)
+		print("Indexed {} latents in {:.1f}s".format(len(latent_index.latent_store), time.time() - start))
+	elif args.mode == 'query':
+		latent_index = LatentIndex.load(latent_path, args.search_k)
+		short_codes = args.shortcode.split(',')
+		start = time.time()
+		results = latent_index.query_shortcode_batch(short_codes, args.k)
+		print("{} queries in {:.2f}ms".format(len(short_codes), (time.time() - start) * 1000))
+		for short_code, (neighbours, distances) in zip(short_codes, results):
+			print(short_code)
+			for neighbour, distance in zip(neighbours, distances):
+				print("\t{}\t{:.4f}".format(neighbour, distance))
+	else:
+		benchmark(latent_path, args)
+
+def benchmark(latent_path, args):
+	latent_index = LatentIndex.load(latent_path)
+	latent_store = latent_index.latent_store
+	rows = np.random.RandomState(42).choice(len(latent_store), min(args.num_queries, len(latent_store)), replace=False)
+	queries = latent_store.get_latents(np.sort(rows)).astype(np.float32)
+
+	start = time.time()
+	exact_rows, _ = exact_search(latent_store, queries, args.k, latent_index.metric)
+	exact_time = (time.time() - start) * 1000 / len(queries)
+	print("exact search: {:.3f}ms per query".format(exact_time))
+
+	n_trees = latent_index.index.get_n_trees()
+	print("search_k\trecall@{}\tms per query".format(args.k))
+	for search_k in [args.k * n_trees // 4, args.k * n_trees, args.k * n_trees * 4, args.k * n_trees * 16]:
+		recall = 0.
+		start = time.time()
+		for query, exact in zip(queries, exact_rows):
+			approximate = latent_index.index.get_nns_by_vector(query, args.k, search_k=search_k)
+			recall += len(set(approximate) & set(exact)) / args.k
+		latency = (time.time() - start) * 1000 / len(queries)
+		print("{}\t{:.4f}\t{:.3f}".format(search_k, recall / len(queries), latency))
+
+
+if __name__ == '__main__':
+	main()
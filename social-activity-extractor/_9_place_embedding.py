@@ -0,0 +1,38 @@
+import argparse
+import config
+import os
+import time
+
+from model.util import LatentStore
+from model.place_embedding import PlaceAggregator, load_post_meta
+
+
+CONFIG = config.Config
+
+def main():
+	parser = argparse.ArgumentParser(description='per place embeddings aggregated from post latents')
+	parser.add_argument('-target_dataset', type=str, default=None, help='folder name of target dataset')
+	parser.add_argument('-incremental', action='store_true', default=False, help='only add posts that are not aggregated yet')
+	parser.add_argument('-time_buckets', type=int, default=CONFIG.PLACE_TIME_BUCKETS, help='number of hour of day buckets')
+	parser.add_argument('-half_life_days', type=float, default=CONFIG.PLACE_HALF_LIFE_DAYS, help='half life of the recency weight')
+
+	args = parser.parse_args()
+
+	aggregate_places(args)
+
+def aggregate_places(args):
+	place_path = os.path.join(CONFIG.PLACE_PATH, args.target_dataset)
+	latent_store = LatentStore(os.path.join(CONFIG.LATENT_PATH, args.target_dataset))
+	post_meta = load_post_meta(CONFIG, args.target_dataset)
+	if args.incremental and os.path.exists(os.path.join(place_path, 'place_state.npz')):
+		aggregator = PlaceAggregator.load(place_path)
+	else:
+		aggregator = PlaceAggregator(latent_store.latents.shards[0].shape[1], args.time_buckets, args.half_life_days * 86400, CONFIG.TIMEZONE_OFFSET)
+	start = time.time()
+	n_posts = aggregator.update(latent_store, post_meta)
+	print("Aggregated {} posts into {} places in {:.1f}s".format(n_posts, len(aggregator.place_ids), time.time() - start))
+	aggregator.save(place_path)
+
+
+if __name__ == '__main__':
+	main()
@@ -14,7 +14,21 @@ class Config:
 	CHECKPOINT_PATH = os.path.join(root_dir, 'processed', 'checkpoint')
 	EMBEDDING_PATH = './embedding'
 	CSV_PATH = './csv'
+	LATENT_PATH = './latent'
+	PLACE_PATH = './place'
+	CLUSTER_PATH = './cluster'
 	MAX_SENTENCE_LEN = 257
 	MIN_WORD_COUNT = 5
 	MAX_SEQUENCE_LEN = 10
-	SVG_PATH = './svg'
\ No newline at end of file
+	FEATURE_SHARD_SIZE = 4096
+	LATENT_SHARD_SIZE = 16384
+	PLACE_TIME_BUCKETS = 4
+	PLACE_HALF_LIFE_DAYS = 90
+	# posts are bucketed by local hour of day (KST)
+	TIMEZONE_OFFSET = 9 * 3600
+	SVG_PATH = './svg'
+	TOKENIZER_WORKERS = os.cpu_count()
+	TOKENIZER_CHUNKSIZE = 256
+	TOKEN_CACHE_PATH = os.path.join('./data', 'token_cache.db')
+	# run okt.pos next to the ASCII fast path and report any difference
+	VERIFY_FAST_TOKENIZER = False
@@ -104,6 +104,9 @@ class AdamW(Optimizer):
 		weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
 		amsgrad (boolean, optional): whether to use the AMSGrad variant of this
 			algorithm from the paper `On the Convergence of Adam and Beyond`_
+		foreach (boolean, optional): whether to update all parameters of a group
+			with multi-tensor operations, None uses them when every parameter
+			is on gpu (default: None)
 	.. _Adam\: A Method for Stochastic Optimization:
 		https://arxiv.org/abs/1412.6980
 	.. _On the Convergence of Adam and Beyond:
@@ -111,7 +114,7 @@ class AdamW(Optimizer):
 	"""
 
 	def __init__(self, params, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-				 weight_decay=0, amsgrad=False):
+				 weight_decay=0, amsgrad=False, foreach=None):
 		if not 0.0 <= lr:
 			raise ValueError("Invalid learning rate: {}".format(lr))
 		if not 0.0 <= eps:
@@ -121,13 +124,15 @@ class AdamW(Optimizer):
 		if not 0.0 <= betas[1] < 1.0:
 			raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
 		defaults = dict(lr=lr, betas=betas, eps=eps,
-						weight_decay=weight_decay, amsgrad=amsgrad)
+						weight_decay=weight_decay, amsgrad=amsgrad, foreach=foreach)
 		super(AdamW, self).__init__(params, defaults)
 
 	def __setstate__(self, state):
 		super(AdamW, self).__setstate__(state)
 		for group in self.param_groups:
 			group.setdefault('amsgrad', False)
+			# optimizer states saved before the foreach update
+			group.setdefault('foreach', None)
 
 	def step(self, closure=None):
 		"""Performs a single optimization step.
@@ -140,13 +145,13 @@ class AdamW(Optimizer):
 			loss = closure()
 
 		for group in self.param_groups:
+			params = []
 			for p in group['params']:
 				if p.grad is None:
 					continue
-				grad = p.grad.data
-				if grad.is_sparse:
+				if p.grad.is_sparse:
 					raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
-				amsgrad = group['amsgrad']
+				params.append(p)
 
 				state = self.state[p]
 
@@ -157,40 +162,88 @@ class AdamW(Optimizer):
 					state['exp_avg'] = torch.zeros_like(p.data)
 					# Exponential moving average of squared gradient values
 					state['exp_avg_sq'] = torch.zeros_like(p.data)
-					if amsgrad:
+					if group['amsgrad']:
 						# Maintains max of all exp. moving avg. of sq. grad. values
 						state['max_exp_avg_sq'] = torch.zeros_like(p.data)
-
-				exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
-				if amsgrad:
-					max_exp_avg_sq = state['max_exp_avg_sq']
-				beta1, beta2 = group['betas']
-
 				state['step'] += 1
 
-				# if group['weight_decay'] != 0:
-				#     grad = grad.add(group['weight_decay'], p.data)
-
-				# Decay the first and second moment running average coefficient
-				exp_avg.mul_(beta1).add_(1 - beta1, grad)
-				exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-				if amsgrad:
-					# Maintains the maximum of all 2nd moment running avg. till now
-					torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
-					# Use the max. for normalizing running avg. of gradient
-					denom = max_exp_avg_sq.sqrt().add_(group['eps'])
-				else:
-					denom = exp_avg_sq.sqrt().add_(group['eps'])
-
-				bias_correction1 = 1 - beta1 ** state['step']
-				bias_correction2 = 1 - beta2 ** state['step']
-				step_size = group['lr'] * math.sqrt(bias_correction2) / bias_correction1
-
-				# p.data.addcdiv_(-step_size, exp_avg, denom)
-				p.data.add_(-step_size,  torch.mul(p.data, group['weight_decay']).addcdiv_(1, exp_avg, denom) )
+			if len(params) == 0:
+				continue
+			foreach = group['foreach']
+			if foreach is None:
+				# multi-tensor kernels pay off on gpu, on cpu the loop stays in cache
+				foreach = all([p.is_cuda for p in params])
+			if foreach:
+				self._multi_tensor_step(group, params)
+			else:
+				self._single_tensor_step(group, params)
 
 		return loss
 
+	def _step_size(self, group, step):
+		beta1, beta2 = group['betas']
+		bias_correction1 = 1 - beta1 ** step
+		bias_correction2 = 1 - beta2 ** step
+		return group['lr'] * math.sqrt(bias_correction2) / bias_correction1
+
+	def _single_tensor_step(self, group, params):
+		beta1, beta2 = group['betas']
+		for p in params:
+			grad = p.grad.data
+			state = self.state[p]
+			exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
+
+			# Decay the first and second moment running average coefficient
+			exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+			exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+			if group['amsgrad']:
+				max_exp_avg_sq = state['max_exp_avg_sq']
+				# Maintains the maximum of all 2nd moment running avg. till now
+				torch.max(max_exp_avg_sq, exp_avg_sq, out=max_exp_avg_sq)
+				# Use the max. for normalizing running avg. of gradient
+				denom = max_exp_avg_sq.sqrt().add_(group['eps'])
+			else:
+				denom = exp_avg_sq.sqrt().add_(group['eps'])
+
+			# the weight decay is scaled by the bias-corrected step size together with the adam update
+			step_size = self._step_size(group, state['step'])
+			p.data.add_(torch.mul(p.data, group['weight_decay']).addcdiv_(exp_avg, denom), alpha=-step_size)
+
+	def _multi_tensor_step(self, group, params):
+		# the same update as _single_tensor_step, one multi-tensor kernel per operation
+		# instead of one kernel per operation and parameter
+		beta1, beta2 = group['betas']
+		states = [self.state[p] for p in params]
+		params_data = [p.data for p in params]
+		grads = [p.grad.data for p in params]
+		exp_avgs = [state['exp_avg'] for state in states]
+		exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+
+		torch._foreach_mul_(exp_avgs, beta1)
+		torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+		torch._foreach_mul_(exp_avg_sqs, beta2)
+		torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+		if group['amsgrad']:
+			max_exp_avg_sqs = [state['max_exp_avg_sq'] for state in states]
+			torch._foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+			denoms = torch._foreach_sqrt(max_exp_avg_sqs)
+		else:
+			denoms = torch._foreach_sqrt(exp_avg_sqs)
+		torch._foreach_add_(denoms, group['eps'])
+
+		if group['weight_decay'] != 0:
+			updates = torch._foreach_mul(params_data, group['weight_decay'])
+			torch._foreach_addcdiv_(updates, exp_avgs, denoms)
+		else:
+			updates = torch._foreach_div(exp_avgs, denoms)
+		# parameters that missed a step because they had no gradient have their own step count
+		steps = [state['step'] for state in states]
+		if all([step == steps[0] for step in steps]):
+			torch._foreach_add_(params_data, updates, alpha=-self._step_size(group, steps[0]))
+		else:
+			torch._foreach_mul_(updates, [-self._step_size(group, step) for step in steps])
+			torch._foreach_add_(params_data, updates)
+
 class ConstantLRSchedule(LambdaLR):
     """ Constant learning rate schedule.
     """
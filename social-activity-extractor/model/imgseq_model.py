@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.nn.init
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.autograd import Variable
 
 import math
@@ -22,11 +23,19 @@ class RNNEncoder(nn.Module):
 		#nn.init.orthogonal_(self.lstm.weight_ih_l0, gain=np.sqrt(2))
 		#nn.init.orthogonal_(self.lstm.weight_hh_l0, gain=np.sqrt(2))
 
-	def __call__(self, x):
-
-		# forward propagate lstm
-		h, _ = self.lstm(x) 
-		return h[:, -1, :]
+	def forward(self, x, lengths=None):
+		if lengths is None:
+			# forward propagate lstm
+			h, _ = self.lstm(x) 
+			return h[:, -1, :]
+		# only the real images of every sequence go through the lstm,
+		# the latent is taken at the last of them instead of after the padding
+		packed_x = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+		# explicit zero state, a traced quantized lstm would keep the batch size it was traced with
+		h0 = x.new_zeros(self.num_layers * (2 if self.lstm.bidirectional else 1), x.size(0), self.lstm.hidden_size)
+		h, _ = self.lstm(packed_x, (h0, h0))
+		h, _ = pad_packed_sequence(h, batch_first=True, total_length=x.size(1))
+		return h[torch.arange(h.size(0), device=h.device), lengths.to(h.device) - 1]
 
 class RNNDecoder(nn.Module):
 	def __init__(self, sequence_len, embed_dim, num_layers, latent_size, bidirectional):
@@ -42,10 +51,16 @@ class RNNDecoder(nn.Module):
 		#nn.init.orthogonal_(self.lstm.weight_ih_l0, gain=np.sqrt(2))
 		#nn.init.orthogonal_(self.lstm.weight_hh_l0, gain=np.sqrt(2))
 
-	def __call__(self, h):
-
-		# forward propagate lstm
-		x_hat, _ = self.lstm(h.unsqueeze(dim=1).expand(-1, self.sequence_len, -1))
+	def forward(self, h, lengths=None):
+		h = h.unsqueeze(dim=1).expand(-1, self.sequence_len, -1)
+		if lengths is None:
+			# forward propagate lstm
+			x_hat, _ = self.lstm(h)
+			return x_hat
+		# padded steps are not computed and come back as zeros
+		packed_h = pack_padded_sequence(h, lengths.cpu(), batch_first=True, enforce_sorted=False)
+		x_hat, _ = self.lstm(packed_h)
+		x_hat, _ = pad_packed_sequence(x_hat, batch_first=True, total_length=self.sequence_len)
 		return x_hat
 
 class ImgseqAutoEncoder(nn.Module):
@@ -54,7 +69,14 @@ class ImgseqAutoEncoder(nn.Module):
 		self.encoder = encoder
 		self.decoder = decoder
 
-	def forward(self, x):
-		h = self.encoder(x)
-		x_hat = self.decoder(h)
-		return x_hat
\ No newline at end of file
+	def forward(self, x, lengths=None):
+		h = self.encoder(x, lengths)
+		x_hat = self.decoder(h, lengths)
+		return x_hat
+
+class MaskedMSELoss(nn.Module):
+	# mean squared error over the real images of every sequence, padding is left out
+	def forward(self, x_hat, x, lengths):
+		mask = torch.arange(x.size(1), device=x.device).unsqueeze(0) < lengths.to(x.device).unsqueeze(1)
+		mask = mask.unsqueeze(2).type_as(x)
+		return ((x_hat - x) ** 2 * mask).sum() / (mask.sum() * x.size(2))
\ No newline at end of file
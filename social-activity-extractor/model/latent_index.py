@@ -0,0 +1,86 @@
+import os
+import json
+import numpy as np
+from annoy import AnnoyIndex
+from tqdm import tqdm
+
+from model.util import LatentStore
+
+class LatentIndex:
+	# Annoy index over a latent store, item i of the index is row i of the store
+	def __init__(self, latent_store, index, metric, search_k=-1):
+		self.latent_store = latent_store
+		self.index = index
+		self.metric = metric
+		self.search_k = search_k
+
+	@classmethod
+	def build(cls, latent_path, n_trees=50, metric='angular', n_jobs=-1):
+		latent_store = LatentStore(latent_path)
+		index = AnnoyIndex(latent_store.latents.shards[0].shape[1], metric)
+		row = 0
+		for _, latents in tqdm(latent_store.iter_shards()):
+			for latent in latents:
+				index.add_item(row, latent)
+				row = row + 1
+		index.build(n_trees, n_jobs=n_jobs)
+		index.save(os.path.join(latent_path, 'latent.ann'))
+		with open(os.path.join(latent_path, 'latent_ann.json'), 'w') as f:
+			json.dump({'metric': metric, 'n_trees': n_trees, 'rows': row}, f)
+		return cls(latent_store, index, metric)
+
+	@classmethod
+	def load(cls, latent_path, search_k=-1):
+		with open(os.path.join(latent_path, 'latent_ann.json'), 'r') as f:
+			meta = json.load(f)
+		latent_store = LatentStore(latent_path)
+		if len(latent_store) != meta['rows']:
+			print("Index covers {} of {} latents, rebuild it to search the new ones".format(meta['rows'], len(latent_store)))
+		index = AnnoyIndex(latent_store.latents.shards[0].shape[1], meta['metric'])
+		# the index file is memory-mapped, so processes on one host share it
+		index.load(os.path.join(latent_path, 'latent.ann'))
+		return cls(latent_store, index, meta['metric'], search_k)
+
+	def query_vector(self, vector, k=10):
+		# (short_codes, distances) of the `k` nearest posts
+		rows, distances = self.index.get_nns_by_vector(np.asarray(vector, dtype=np.float32), k, search_k=self.search_k, include_distances=True)
+		return self.latent_store.short_codes[rows], np.array(distances, dtype=np.float32)
+
+	def query_shortcode(self, short_code, k=10):
+		# nearest posts to a post of the store, leaving the post itself out
+		row = self.latent_store.get_rows([short_code])[0]
+		if row < 0:
+			raise KeyError(short_code)
+		rows, distances = self.index.get_nns_by_item(int(row), k + 1, search_k=self.search_k, include_distances=True)
+		keep = [i for i, _row in enumerate(rows) if _row != row][:k]
+		return self.latent_store.short_codes[np.array(rows)[keep]], np.array(distances, dtype=np.float32)[keep]
+
+	def query_batch(self, vectors, k=10):
+		return [self.query_vector(vector, k) for vector in vectors]
+
+	def query_shortcode_batch(self, short_codes, k=10):
+		return [self.query_shortcode(short_code, k) for short_code in short_codes]
+
+def exact_search(latent_store, vectors, k=10, metric='angular'):
+	# brute-force (rows, distances) of the `k` nearest rows of every vector, shard by shard
+	vectors = np.asarray(vectors, dtype=np.float32)
+	if metric == 'angular':
+		vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+	best_rows = np.empty((len(vectors), 0), dtype=np.int64)
+	best_distances = np.empty((len(vectors), 0), dtype=np.float32)
+	offset = 0
+	for _, latents in latent_store.iter_shards():
+		latents = np.asarray(latents, dtype=np.float32)
+		if metric == 'angular':
+			latents = latents / np.linalg.norm(latents, axis=1, keepdims=True)
+			# annoy's angular distance is the euclidean distance of the normalized vectors
+			distances = np.sqrt(np.maximum(2. - 2. * vectors.dot(latents.T), 0.))
+		else:
+			distances = np.sqrt(np.maximum((vectors ** 2).sum(1)[:, np.newaxis] - 2. * vectors.dot(latents.T) + (latents ** 2).sum(1)[np.newaxis], 0.))
+		best_rows = np.concatenate([best_rows, np.broadcast_to(np.arange(offset, offset + len(latents)), distances.shape)], axis=1)
+		best_distances = np.concatenate([best_distances, distances], axis=1)
+		top = np.argsort(best_distances, axis=1)[:, :k]
+		best_rows = np.take_along_axis(best_rows, top, axis=1)
+		best_distances = np.take_along_axis(best_distances, top, axis=1)
+		offset = offset + len(latents)
+	return best_rows, best_distances
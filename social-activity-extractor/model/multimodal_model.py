@@ -9,6 +9,10 @@ import numpy as np
 
 from model.component import SiLU, Maxout, PTanh
 
+def quantize_encoder(encoder):
+	# int8 weights for every LSTM and Linear layer, activations are quantized on the fly (cpu only)
+	return torch.ao.quantization.quantize_dynamic(encoder, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
 class MultimodalEncoder(nn.Module):
 	def __init__(self, text_encoder, imgseq_encoder, latent_size):
 		super(MultimodalEncoder, self).__init__()
@@ -19,12 +23,34 @@ class MultimodalEncoder(nn.Module):
 			nn.Linear(latent_size*2, int(latent_size*2/3)),
 			nn.SELU(),
 			nn.Linear(int(latent_size*2/3), latent_size))
-	def __call__(self, text, imgseq):
+	def forward(self, text, imgseq, imgseq_len=None):
 		text_h = self.text_encoder(text)
-		imgseq_h = self.imgseq_encoder(imgseq)
+		imgseq_h = self.imgseq_encoder(imgseq, imgseq_len)
 		h = self.multimodal_encoder(torch.cat((text_h, imgseq_h), dim=-1))
 		return h
 
+class BucketedEncoder(nn.Module):
+	# runs every caption at the length of its bucket, the way a text encoder trained with
+	# -buckets saw it, and puts the latents back in batch order
+	def __init__(self, encoder, buckets, pad_idx):
+		super(BucketedEncoder, self).__init__()
+		self.encoder = encoder
+		self.buckets = buckets
+		self.pad_idx = pad_idx
+
+	def forward(self, text, imgseq, imgseq_len=None):
+		buckets = torch.tensor(self.buckets, device=text.device)
+		lengths = (text != self.pad_idx).sum(dim=1)
+		bucket_lens = buckets[torch.clamp(torch.searchsorted(buckets, lengths), max=len(self.buckets) - 1)]
+		h = None
+		for bucket_len in bucket_lens.unique().tolist():
+			rows = (bucket_lens == bucket_len).nonzero().squeeze(1)
+			bucket_h = self.encoder(text[rows, :bucket_len], imgseq[rows], None if imgseq_len is None else imgseq_len[rows.cpu()])
+			if h is None:
+				h = bucket_h.new_empty(text.size(0), bucket_h.size(1))
+			h[rows] = bucket_h
+		return h
+
 class MultimodalDecoder(nn.Module):
 	def __init__(self, text_decoder, imgseq_decoder, latent_size, sequence_len):
 		super(MultimodalDecoder, self).__init__()
@@ -38,19 +64,32 @@ class MultimodalDecoder(nn.Module):
 			nn.Linear(int(latent_size*2/3), latent_size*2),
 			nn.Tanh())
 
-	def __call__(self, h):
+	def forward(self, h, imgseq_len=None, sentence_len=None):
 		decode_h = torch.split(self.multimodal_decoder(h), self.latent_size, dim=-1)
-		text_hat = self.text_decoder(decode_h[0])
-		imgseq_hat = self.imgseq_decoder(decode_h[1])
+		text_hat = self.text_decoder(decode_h[0], sentence_len)
+		imgseq_hat = self.imgseq_decoder(decode_h[1], imgseq_len)
 		return text_hat, imgseq_hat
 
+	def sampled_forward(self, h, text, imgseq_len=None):
+		decode_h = torch.split(self.multimodal_decoder(h), self.latent_size, dim=-1)
+		text_hat, text_target, candidates = self.text_decoder.sampled_log_prob(decode_h[0], text)
+		imgseq_hat = self.imgseq_decoder(decode_h[1], imgseq_len)
+		return text_hat, text_target, candidates, imgseq_hat
+
 class MultimodalAutoEncoder(nn.Module):
 	def __init__(self, encoder, decoder):
 		super(MultimodalAutoEncoder, self).__init__()
 		self.encoder = encoder
 		self.decoder = decoder
 
-	def forward(self, text, imgseq):
-		h = self.encoder(text, imgseq)
-		text_hat, imgseq_hat = self.decoder(h)
-		return text_hat, imgseq_hat
\ No newline at end of file
+	def forward(self, text, imgseq, imgseq_len=None, sampled=False):
+		# sampled=True runs sampled_forward, so it also goes through DistributedDataParallel
+		if sampled:
+			return self.sampled_forward(text, imgseq, imgseq_len)
+		h = self.encoder(text, imgseq, imgseq_len)
+		text_hat, imgseq_hat = self.decoder(h, imgseq_len, text.size(1))
+		return text_hat, imgseq_hat
+
+	def sampled_forward(self, text, imgseq, imgseq_len=None):
+		h = self.encoder(text, imgseq, imgseq_len)
+		return self.decoder.sampled_forward(h, text, imgseq_len)
\ No newline at end of file
@@ -0,0 +1,138 @@
+import os
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+def load_post_meta(CONFIG, target_dataset):
+	# (shortcode index, loc_ids, timestamps) written by `make_post_meta` of _4_arrange_dataset
+	post_meta = np.load(os.path.join(CONFIG.DATASET_PATH, target_dataset, 'post_meta.npz'))
+	return pd.Index(post_meta['short_codes']), post_meta['loc_ids'], post_meta['timestamps']
+
+def segment_sum(values, segments, n_segments):
+	# float64 sum of the rows of `values` that share a segment id, `segments` must be sorted
+	sums = np.zeros((n_segments,) + values.shape[1:], dtype=np.float64)
+	if len(values) == 0:
+		return sums
+	starts = np.flatnonzero(np.concatenate([[True], segments[1:] != segments[:-1]]))
+	sums[segments[starts]] = np.add.reduceat(values, starts, axis=0, dtype=np.float64)
+	return sums
+
+class PlaceAggregator:
+	# running per-place sums of post latents, so new posts are added without a full pass.
+	# weighted embeddings decay every post by its age, halving every `half_life` seconds,
+	# bucketed embeddings split the posts by local hour of day into `n_buckets` buckets
+	def __init__(self, dim, n_buckets=4, half_life=90 * 86400, timezone_offset=9 * 3600):
+		self.dim = dim
+		self.n_buckets = n_buckets
+		self.half_life = half_life
+		self.timezone_offset = timezone_offset
+		self.reference_time = 0
+		self.place_ids = np.array([], dtype=str)
+		self.counts = np.zeros(0, dtype=np.int64)
+		self.sums = np.zeros((0, dim), dtype=np.float64)
+		self.weights = np.zeros(0, dtype=np.float64)
+		self.weighted_sums = np.zeros((0, dim), dtype=np.float64)
+		self.bucket_counts = np.zeros((0, n_buckets), dtype=np.int64)
+		self.bucket_sums = np.zeros((0, n_buckets, dim), dtype=np.float64)
+		# posts already in the sums and the checkpoint and input hashes of their latents
+		self.short_codes = np.array([], dtype=str)
+		self.checkpoints = np.zeros(0, dtype=np.uint64)
+		self.inputs = np.zeros(0, dtype=np.uint64)
+
+	def add_places(self, loc_ids):
+		place_ids = pd.unique(loc_ids)
+		new_place_ids = place_ids[pd.Index(self.place_ids).get_indexer(place_ids) < 0]
+		n_new = len(new_place_ids)
+		if n_new > 0:
+			self.place_ids = np.concatenate([self.place_ids, np.asarray(new_place_ids, dtype=str)])
+			self.counts = np.concatenate([self.counts, np.zeros(n_new, dtype=np.int64)])
+			self.sums = np.concatenate([self.sums, np.zeros((n_new, self.dim))])
+			self.weights = np.concatenate([self.weights, np.zeros(n_new)])
+			self.weighted_sums = np.concatenate([self.weighted_sums, np.zeros((n_new, self.dim))])
+			self.bucket_counts = np.concatenate([self.bucket_counts, np.zeros((n_new, self.n_buckets), dtype=np.int64)])
+			self.bucket_sums = np.concatenate([self.bucket_sums, np.zeros((n_new, self.n_buckets, self.dim))])
+		return pd.Index(self.place_ids).get_indexer(loc_ids)
+
+	def get_new_rows(self, latent_store):
+		# rows of `latent_store` that are not in the sums yet, or None if a post in the
+		# sums was re-encoded since and everything has to be aggregated again
+		aggregated = pd.Index(self.short_codes)
+		known = aggregated.get_indexer(latent_store.short_codes)
+		changed = (latent_store.checkpoints[known >= 0] != self.checkpoints[known[known >= 0]]) | \
+				  (latent_store.inputs[known >= 0] != self.inputs[known[known >= 0]])
+		if changed.any():
+			return None
+		return np.flatnonzero(known < 0)
+
+	def update(self, latent_store, post_meta, chunk_size=65536):
+		rows = self.get_new_rows(latent_store)
+		if rows is None:
+			print("Aggregated posts were re-encoded, aggregating everything again")
+			self.__init__(self.dim, self.n_buckets, self.half_life, self.timezone_offset)
+			rows = np.arange(len(latent_store))
+		meta_index, loc_ids, timestamps = post_meta
+		meta_rows = meta_index.get_indexer(latent_store.short_codes[rows])
+		print("Posts without location metadata skipped: {} of {}".format(int((meta_rows < 0).sum()), len(rows)))
+		rows, meta_rows = rows[meta_rows >= 0], meta_rows[meta_rows >= 0]
+		if len(rows) == 0:
+			return 0
+		places = self.add_places(loc_ids[meta_rows])
+		timestamps = timestamps[meta_rows].astype(np.int64)
+
+		# move the weighted sums to the newest post, decaying them by the time in between
+		reference_time = max(self.reference_time, int(timestamps.max()))
+		decay = 0.5 ** ((reference_time - self.reference_time) / self.half_life)
+		self.weights *= decay
+		self.weighted_sums *= decay
+		self.reference_time = reference_time
+
+		n_places = len(self.place_ids)
+		weights = 0.5 ** ((reference_time - timestamps) / self.half_life)
+		buckets = ((timestamps + self.timezone_offset) % 86400) * self.n_buckets // 86400
+		bucket_segments = places * self.n_buckets + buckets
+		self.counts += np.bincount(places, minlength=n_places)
+		self.weights += np.bincount(places, weights=weights, minlength=n_places)
+		self.bucket_counts += np.bincount(bucket_segments, minlength=n_places * self.n_buckets).reshape(n_places, self.n_buckets)
+		for start in tqdm(range(0, len(rows), chunk_size)):
+			# within a chunk the posts are read in bucket order, which is also place order
+			order = start + np.argsort(bucket_segments[start:start + chunk_size], kind='stable')
+			latents = latent_store.get_latents(rows[order])
+			bucket_sums = segment_sum(latents, bucket_segments[order], n_places * self.n_buckets).reshape(n_places, self.n_buckets, self.dim)
+			self.bucket_sums += bucket_sums
+			self.sums += bucket_sums.sum(axis=1)
+			self.weighted_sums += segment_sum(latents * weights[order, np.newaxis].astype(latents.dtype), places[order], n_places)
+
+		self.short_codes = np.concatenate([self.short_codes, latent_store.short_codes[rows]])
+		self.checkpoints = np.concatenate([self.checkpoints, latent_store.checkpoints[rows]])
+		self.inputs = np.concatenate([self.inputs, latent_store.inputs[rows]])
+		return len(rows)
+
+	def get_embeddings(self):
+		# float32 mean, recency-weighted and per-bucket mean embedding of every place,
+		# zero where a place or bucket has no posts
+		mean = self.sums / np.maximum(self.counts, 1)[:, np.newaxis]
+		weighted = self.weighted_sums / np.maximum(self.weights, np.finfo(np.float64).tiny)[:, np.newaxis]
+		bucketed = self.bucket_sums / np.maximum(self.bucket_counts, 1)[:, :, np.newaxis]
+		return mean.astype(np.float32), weighted.astype(np.float32), bucketed.astype(np.float32)
+
+	def save(self, path):
+		if not os.path.exists(path):
+			os.makedirs(path)
+		np.savez(os.path.join(path, 'place_state.npz'), dim=self.dim, n_buckets=self.n_buckets, half_life=self.half_life,
+				 timezone_offset=self.timezone_offset, reference_time=self.reference_time, place_ids=self.place_ids,
+				 counts=self.counts, sums=self.sums, weights=self.weights, weighted_sums=self.weighted_sums,
+				 bucket_counts=self.bucket_counts, bucket_sums=self.bucket_sums, short_codes=self.short_codes, checkpoints=self.checkpoints, inputs=self.inputs)
+		mean, weighted, bucketed = self.get_embeddings()
+		np.savez(os.path.join(path, 'place_embedding.npz'), place_ids=self.place_ids, counts=self.counts, mean=mean,
+				 weighted=weighted, bucket_counts=self.bucket_counts, bucketed=bucketed, reference_time=self.reference_time)
+
+	@classmethod
+	def load(cls, path):
+		state = np.load(os.path.join(path, 'place_state.npz'))
+		aggregator = cls(int(state['dim']), int(state['n_buckets']), float(state['half_life']), int(state['timezone_offset']))
+		aggregator.reference_time = int(state['reference_time'])
+		for key in ['place_ids', 'counts', 'sums', 'weights', 'weighted_sums', 'bucket_counts', 'bucket_sums', 'short_codes', 'inputs']:
+			setattr(aggregator, key, state[key])
+		# states saved without checkpoint hashes never match, so they are aggregated again
+		aggregator.checkpoints = state['checkpoints'] if 'checkpoints' in state else np.zeros(len(aggregator.short_codes), dtype=np.uint64)
+		return aggregator
@@ -9,6 +9,22 @@ import numpy as np
 
 from model.component import SiLU, Maxout, PTanh
 
+def conv_output_len(sentence_len, filter_shape):
+	# length after the two stride-2 convolutions, i.e. the `t3` of the training scripts
+	t2 = int(math.floor((sentence_len - filter_shape) / 2) + 1)
+	return int(math.floor((t2 - filter_shape) / 2) + 1)
+
+def valid_sentence_len(sentence_len, filter_shape):
+	# smallest length >= sentence_len that the deconvolutions reproduce exactly
+	t3 = int(math.ceil((sentence_len - 3 * filter_shape + 6) / 4))
+	return 4 * t3 + 3 * filter_shape - 6
+
+def make_buckets(bucket_arg, filter_shape, max_sentence_len):
+	# sentence lengths of a comma separated -buckets argument, each padded only to its own
+	# length; the longest one is max_sentence_len
+	buckets = [valid_sentence_len(int(bucket), filter_shape) for bucket in bucket_arg.split(',')]
+	return sorted(set([bucket for bucket in buckets if bucket < max_sentence_len] + [max_sentence_len]))
+
 class ConvolutionEncoder(nn.Module):
 	def __init__(self, embedding, sentence_len, filter_size, filter_shape, latent_size):
 		super(ConvolutionEncoder, self).__init__()
@@ -37,7 +53,7 @@ class ConvolutionEncoder(nn.Module):
 				if m.bias is not None:
 					torch.nn.init.constant_(m.bias, 0.001)
 
-	def __call__(self, x):
+	def forward(self, x):
 		x = self.embedding(x)
 
 		# x.size() is (L, emb_dim) if batch_size is 1.
@@ -49,11 +65,49 @@ class ConvolutionEncoder(nn.Module):
 		# x = F.relu(x)
 		h1 = self.convs1(x)
 		h2 = self.convs2(h1)
-		h = self.convs3(h2).squeeze().squeeze()
+		conv = self.convs3[0]
+		if h2.size(2) == conv.kernel_size[0]:
+			h = self.convs3(h2)
+		else:
+			# shorter (bucketed) sentence: use the leading rows of the full-length kernel
+			h = self.convs3[1](F.conv2d(h2, conv.weight[:, :, :h2.size(2)], conv.bias))
+		h = h.squeeze(3).squeeze(2)
+		return h
+
+def fold_batch_norm(conv, batch_norm):
+	# weight and bias of `conv` followed by `batch_norm` in eval mode as a single convolution
+	scale = batch_norm.weight / torch.sqrt(batch_norm.running_var + batch_norm.eps)
+	weight = conv.weight * scale.view(-1, *([1] * (conv.weight.dim() - 1)))
+	bias = (conv.bias - batch_norm.running_mean) * scale + batch_norm.bias
+	return weight.detach(), bias.detach()
+
+class FoldedConvolutionEncoder(nn.Module):
+	# inference-only ConvolutionEncoder for full-length sentences with the batch norms folded in.
+	# the (filter_shape, emb_dim) convolution over one channel is a conv1d over the embedding
+	# channels and the last full-length convolution is a linear layer, both much faster on cpu
+	def __init__(self, encoder):
+		super(FoldedConvolutionEncoder, self).__init__()
+		self.embedding = encoder.embedding
+		weight1, bias1 = fold_batch_norm(encoder.convs1[0], encoder.convs1[1])
+		weight2, bias2 = fold_batch_norm(encoder.convs2[0], encoder.convs2[1])
+		self.register_buffer('weight1', weight1.squeeze(1).transpose(1, 2).contiguous())
+		self.register_buffer('bias1', bias1)
+		self.register_buffer('weight2', weight2.squeeze(3).contiguous())
+		self.register_buffer('bias2', bias2)
+		conv3 = encoder.convs3[0]
+		self.linear3 = nn.Linear(conv3.weight[0].numel(), conv3.out_channels)
+		self.linear3.weight.data.copy_(conv3.weight.detach().flatten(1))
+		self.linear3.bias.data.copy_(conv3.bias.detach())
+
+	def forward(self, x):
+		x = self.embedding(x).transpose(1, 2)
+		h1 = F.selu(F.conv1d(x, self.weight1, self.bias1, stride=2))
+		h2 = F.selu(F.conv1d(h1, self.weight2, self.bias2, stride=2))
+		h = torch.tanh(self.linear3(h2.flatten(1)))
 		return h
 
 class DeconvolutionDecoder(nn.Module):
-	def __init__(self, embedding, tau, sentence_len, filter_size, filter_shape, latent_size, device):
+	def __init__(self, embedding, tau, sentence_len, filter_size, filter_shape, latent_size, device, num_sampled=0):
 		super(DeconvolutionDecoder, self).__init__()
 		self.embedding = embedding
 		self.deconvs1 = nn.Sequential(
@@ -73,6 +127,11 @@ class DeconvolutionDecoder(nn.Module):
 		self.tau = tau
 		self.softmax = nn.LogSoftmax(dim=2)
 		self.device = device
+		self.num_sampled = num_sampled
+		# L2-normalized copy of the frozen embedding, rebuilt only when the weights change.
+		# not persistent, so checkpoints keep their keys
+		self.register_buffer('normalized_weight', F.normalize(self.embedding.weight.data, p=2, dim=1), persistent=False)
+		self.weight_version = self.get_weight_version()
 
 		# weight initialize for conv_transpose layer
 		for m in self.modules():
@@ -81,8 +140,16 @@ class DeconvolutionDecoder(nn.Module):
 				if m.bias is not None:
 					torch.nn.init.constant_(m.bias, 0.001)
 
-	def __call__(self, h):
-		h2 = self.deconvs1(h.unsqueeze(dim=-1).unsqueeze(dim=-1))
+	def deconvolve(self, h, sentence_len=None):
+		h = h.unsqueeze(dim=-1).unsqueeze(dim=-1)
+		deconv = self.deconvs1[0]
+		t3 = deconv.kernel_size[0]
+		if sentence_len is not None:
+			t3 = conv_output_len(sentence_len, self.deconvs2[0].kernel_size[0])
+		if t3 == deconv.kernel_size[0]:
+			h2 = self.deconvs1(h)
+		else:
+			h2 = self.deconvs1[2](self.deconvs1[1](F.conv_transpose2d(h, deconv.weight[:, :, :t3], deconv.bias)))
 		h1 = self.deconvs2(h2)
 		x_hat = self.deconvs3(h1).squeeze()
 		
@@ -91,21 +158,57 @@ class DeconvolutionDecoder(nn.Module):
 		if len(x_hat.size()) < 3:
 			x_hat = x_hat.view(1, *x_hat.size())
 		normalized_x_hat = F.normalize(x_hat, p=2, dim=2)
-		w = Variable(self.embedding.weight.data).to(self.device)
-		normalized_w = F.normalize(w, p=2, dim=1)
+		return normalized_x_hat
+
+	def get_weight_version(self):
+		weight = self.embedding.weight
+		return (weight._version, weight.data_ptr(), weight.device)
+
+	def get_normalized_weight(self):
+		# load_state_dict copies into the weight in place, which bumps its version counter.
+		# a fine-tuned embedding is updated through .data, so it is normalized on every call
+		version = self.get_weight_version()
+		if self.embedding.weight.requires_grad or version != self.weight_version:
+			self.normalized_weight = F.normalize(self.embedding.weight.data, p=2, dim=1)
+			self.weight_version = version
+		return self.normalized_weight
+
+	def forward(self, h, sentence_len=None):
+		normalized_x_hat = self.deconvolve(h, sentence_len)
+		normalized_w = self.get_normalized_weight()
 		prob_logits = torch.tensordot(normalized_x_hat, normalized_w, [[2], [1]]) / self.tau
 		log_prob = self.softmax(prob_logits)
 		return log_prob
 
+	def sampled_log_prob(self, h, target):
+		# sampled softmax for training: the softmax runs over the words of `target` plus
+		# `num_sampled` uniformly drawn negatives instead of the whole vocabulary.
+		# returns log-probabilities over the candidates, `target` re-indexed into them
+		# and the candidate word indices; use forward for the exact full softmax.
+		normalized_x_hat = self.deconvolve(h, target.size(1))
+		normalized_w = self.get_normalized_weight()
+		negative = torch.randint(0, normalized_w.size(0), (self.num_sampled,), device=target.device)
+		candidates, inverse = torch.unique(torch.cat((target.reshape(-1), negative)), return_inverse=True)
+		normalized_w = normalized_w[candidates]
+		prob_logits = torch.tensordot(normalized_x_hat, normalized_w, [[2], [1]]) / self.tau
+		log_prob = self.softmax(prob_logits)
+		return log_prob, inverse[:target.numel()].view_as(target), candidates
+
 class TextAutoencoder(nn.Module):
 	def __init__(self, encoder, decoder):
 		super(TextAutoencoder, self).__init__()
 		self.encoder = encoder
 		self.decoder = decoder
 
-	def __call__(self, x):
-
+	def forward(self, x, sampled=False):
+		# sampled=True runs sampled_forward, so it also goes through DistributedDataParallel
+		if sampled:
+			return self.sampled_forward(x)
 		h = self.encoder(x)
-		log_prob = self.decoder(h)
+		log_prob = self.decoder(h, x.size(1))
+
+		return log_prob
 
-		return log_prob
\ No newline at end of file
+	def sampled_forward(self, x):
+		h = self.encoder(x)
+		return self.decoder.sampled_log_prob(h, x)
\ No newline at end of file
@@ -1,189 +1,612 @@
 import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import torchvision.transforms as transforms
 from torchvision.datasets.folder import pil_loader
-from torch.utils.data import Dataset, random_split
+from torch.utils.data import Dataset, DataLoader, random_split, DistributedSampler
+from torch.utils.data.sampler import Sampler, BatchSampler, RandomSampler, SequentialSampler
 import math
 import os
 import sys
+import hashlib
+import json
 import numpy as np
 import pandas as pd
 import _pickle as cPickle
+from glob import glob
+from contextlib import contextmanager
 from tqdm import tqdm
 
 torch.manual_seed(42)
-def load_text_data(args, CONFIG, word2idx):	
-	full_data = []
-	df_data = pd.read_csv(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'posts.csv'), header=None, encoding='utf-8-sig')
-	pbar = tqdm(total=df_data.shape[0])
-	for index, row in df_data.iterrows():
-		pbar.update(1)
-		text_data = row.iloc[1]
-		full_data.append(text_data)
-		del text_data
-	pbar.close()
+
+def row_hashes(data):
+	# 64-bit content hash of every row
+	hashes = np.empty(len(data), dtype=np.uint64)
+	for row in range(len(data)):
+		digest = hashlib.blake2b(np.ascontiguousarray(data[row]).tobytes(), digest_size=8).digest()
+		hashes[row] = int.from_bytes(digest, 'little')
+	return hashes
+
+def file_hash(path, salt=b''):
+	sha1 = hashlib.sha1(salt)
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			sha1.update(block)
+	return np.uint64(int.from_bytes(sha1.digest()[:8], 'little'))
+
+class ShardWriter:
+	# appends rows to `<prefix>_<n>.npy` files of at most `shard_size` rows each,
+	# numbering new shards after the ones already in `path`
+	def __init__(self, path, prefix, shard_size, dtype=np.float32):
+		if not os.path.exists(path):
+			os.makedirs(path)
+		self.path = path
+		self.prefix = prefix
+		self.shard_size = shard_size
+		self.dtype = dtype
+		self.shard_id = len(glob(os.path.join(path, prefix + '_*.npy')))
+		self.buffer = None
+		self.buffer_len = 0
+
+	def append(self, rows):
+		rows = np.asarray(rows, dtype=self.dtype)
+		while len(rows) > 0:
+			if self.buffer is None:
+				self.buffer = np.empty((self.shard_size,) + rows.shape[1:], dtype=self.dtype)
+			length = min(len(rows), self.shard_size - self.buffer_len)
+			self.buffer[self.buffer_len:self.buffer_len + length] = rows[:length]
+			self.buffer_len = self.buffer_len + length
+			rows = rows[length:]
+			if self.buffer_len == self.shard_size:
+				self.flush()
+
+	def flush(self):
+		if self.buffer_len > 0:
+			np.save(os.path.join(self.path, '{}_{:05d}.npy'.format(self.prefix, self.shard_id)), self.buffer[:self.buffer_len])
+			self.shard_id = self.shard_id + 1
+		self.buffer = None
+		self.buffer_len = 0
+
+	def close(self):
+		self.flush()
+
+class ShardReader:
+	# memory-mapped view over the shards written by ShardWriter
+	def __init__(self, path, prefix, mmap_mode='r'):
+		shard_paths = sorted(glob(os.path.join(path, prefix + '_*.npy')))
+		self.shards = [np.load(shard_path, mmap_mode=mmap_mode) for shard_path in shard_paths]
+		self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+	def __len__(self):
+		return int(self.offsets[-1])
+
+	def __getitem__(self, row):
+		shard_id = np.searchsorted(self.offsets, row, side='right') - 1
+		return self.shards[shard_id][row - self.offsets[shard_id]]
+
+	def take(self, rows):
+		rows = np.asarray(rows)
+		shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+		data = np.empty((len(rows),) + self.shards[0].shape[1:], dtype=self.shards[0].dtype)
+		for shard_id in np.unique(shard_ids):
+			mask = shard_ids == shard_id
+			data[mask] = self.shards[shard_id][rows[mask] - self.offsets[shard_id]]
+		return data
+
+	def put(self, rows, data):
+		# needs mmap_mode='r+'
+		rows = np.asarray(rows)
+		shard_ids = np.searchsorted(self.offsets, rows, side='right') - 1
+		for shard_id in np.unique(shard_ids):
+			mask = shard_ids == shard_id
+			self.shards[shard_id][rows[mask] - self.offsets[shard_id]] = data[mask]
+			self.shards[shard_id].flush()
+
+class ImageFeatureWriter:
+	def __init__(self, path, shard_size):
+		# a feature store is always rewritten as a whole
+		for shard_path in glob(os.path.join(path, 'features_*.npy')):
+			os.remove(shard_path)
+		self.path = path
+		self.features = ShardWriter(path, 'features', shard_size)
+		self.short_codes = []
+		self.counts = []
+		self.hashes = []
+
+	def append(self, short_code, image_data, image_count):
+		self.features.append(image_data[np.newaxis])
+		self.short_codes.append(short_code)
+		self.counts.append(image_count)
+		self.hashes.append(row_hashes(image_data[np.newaxis])[0])
+
+	def close(self):
+		self.features.close()
+		np.save(os.path.join(self.path, 'shortcodes.npy'), np.array(self.short_codes, dtype=str))
+		np.save(os.path.join(self.path, 'counts.npy'), np.array(self.counts, dtype=np.int32))
+		np.save(os.path.join(self.path, 'hashes.npy'), np.array(self.hashes, dtype=np.uint64))
+
+class ImageFeatureStore:
+	# (N, MAX_SEQUENCE_LEN, dim) image features of a dataset with a shortcode index
+	def __init__(self, path):
+		self.features = ShardReader(path, 'features')
+		self.short_codes = np.load(os.path.join(path, 'shortcodes.npy'))
+		self.counts = np.load(os.path.join(path, 'counts.npy'))
+		self.index = pd.Index(self.short_codes)
+		self.path = path
+		self.hashes = None
+
+	def __len__(self):
+		return len(self.features)
+
+	def get_features(self, rows):
+		# float32 copy of one row or of a batch of rows
+		if np.ndim(rows) == 0:
+			return np.array(self.features[rows])
+		return self.features.take(rows)
+
+	def get_lengths(self, rows):
+		# number of real images of one row or of a batch of rows, the rest is padding
+		return np.asarray(np.clip(self.counts[rows], 1, self.features.shards[0].shape[1]), dtype=np.int64)
+
+	def get_rows(self, short_codes):
+		# row of each shortcode, -1 where it has no features
+		return self.index.get_indexer(short_codes)
+
+	def get_hashes(self, rows):
+		if self.hashes is None:
+			hash_path = os.path.join(self.path, 'hashes.npy')
+			if not os.path.exists(hash_path):
+				# stores written before hashes.npy are hashed once
+				print("Hashing image features...")
+				np.save(hash_path, np.concatenate([row_hashes(shard) for shard in tqdm(self.features.shards)]))
+			self.hashes = np.load(hash_path)
+		return self.hashes[rows]
+
+class LatentWriter:
+	# latents of a dataset as `latent_<n>.npy` shards with the shortcode of every row.
+	# manifest.npz keeps the checkpoint and input hash every latent was encoded from
+	def __init__(self, path, shard_size, dtype=np.float32, append=False):
+		self.path = path
+		self.store = None
+		if append and os.path.exists(os.path.join(path, 'manifest.npz')):
+			self.store = LatentStore(path, mmap_mode='r+')
+			dtype = self.store.latents.shards[0].dtype
+			self.short_codes = list(self.store.short_codes)
+			self.checkpoints = list(self.store.checkpoints)
+			self.inputs = list(self.store.inputs)
+		else:
+			# otherwise the store is rewritten as a whole
+			for shard_path in glob(os.path.join(path, 'latent_*.npy')):
+				os.remove(shard_path)
+			self.short_codes = []
+			self.checkpoints = []
+			self.inputs = []
+		self.latents = ShardWriter(path, 'latent', shard_size, dtype)
+
+	def get_stale(self, short_codes, checkpoint, inputs):
+		# mask of the posts that have no latent yet or one encoded from another checkpoint or input
+		if self.store is None:
+			return np.ones(len(short_codes), dtype=bool)
+		rows = self.store.get_rows(short_codes)
+		known = rows >= 0
+		stale = ~known
+		stale[known] = (self.store.checkpoints[rows[known]] != checkpoint) | (self.store.inputs[rows[known]] != inputs[known])
+		return stale
+
+	def append(self, short_codes, latents, checkpoint, inputs):
+		latents = np.asarray(latents)
+		rows = self.store.get_rows(short_codes) if self.store is not None else np.full(len(short_codes), -1)
+		known = rows >= 0
+		if known.any():
+			# re-encoded posts are overwritten in place
+			self.store.latents.put(rows[known], latents[known].astype(self.latents.dtype))
+			for row, _inputs in zip(rows[known], inputs[known]):
+				self.checkpoints[row] = checkpoint
+				self.inputs[row] = _inputs
+		self.latents.append(latents[~known])
+		self.short_codes.extend(np.asarray(short_codes)[~known])
+		self.checkpoints.extend([checkpoint] * int((~known).sum()))
+		self.inputs.extend(inputs[~known])
+
+	def close(self):
+		self.latents.close()
+		np.save(os.path.join(self.path, 'shortcodes.npy'), np.array(self.short_codes, dtype=str))
+		np.savez(os.path.join(self.path, 'manifest.npz'), checkpoints=np.array(self.checkpoints, dtype=np.uint64), inputs=np.array(self.inputs, dtype=np.uint64))
+
+class LatentStore:
+	def __init__(self, path, mmap_mode='r'):
+		self.latents = ShardReader(path, 'latent', mmap_mode)
+		self.short_codes = np.load(os.path.join(path, 'shortcodes.npy'))
+		self.index = pd.Index(self.short_codes)
+		manifest_path = os.path.join(path, 'manifest.npz')
+		if os.path.exists(manifest_path):
+			manifest = np.load(manifest_path)
+			self.checkpoints = manifest['checkpoints']
+			self.inputs = manifest['inputs']
+
+	def __len__(self):
+		return len(self.latents)
+
+	def get_latents(self, rows):
+		if np.ndim(rows) == 0:
+			return np.array(self.latents[rows])
+		return self.latents.take(rows)
+
+	def get_rows(self, short_codes):
+		# row of each shortcode, -1 where it has no latent
+		return self.index.get_indexer(short_codes)
+
+	def iter_shards(self):
+		# (short_codes, latents) of every shard in row order
+		for shard_id, shard in enumerate(self.latents.shards):
+			offset = self.latents.offsets[shard_id]
+			yield self.short_codes[offset:offset + len(shard)], shard
+
+class Vocabulary:
+	# idx -> word is a numpy string array saved as `vocab.npy`, word -> idx is a hash index over it
+	def __init__(self, idx2word):
+		self.idx2word = np.asarray(idx2word, dtype=np.str_)
+		self.index = pd.Index(self.idx2word)
+
+	def __len__(self):
+		return len(self.idx2word)
+
+	def __contains__(self, word):
+		return word in self.index
+
+	def __getitem__(self, word):
+		return self.index.get_loc(word)
+
+	def get_indices(self, words):
+		# index of every word, -1 where it is not in the vocabulary
+		return self.index.get_indexer(words)
+
+	def decode(self, index):
+		# one sentence per row of `index`
+		words = self.idx2word[np.asarray(index)]
+		if words.ndim == 1:
+			return " ".join(words)
+		return [" ".join(row) for row in words]
+
+	def hash(self):
+		return hashlib.sha1('\n'.join(self.idx2word).encode('utf-8')).hexdigest()
+
+	def save(self, path):
+		np.save(os.path.join(path, 'vocab.npy'), self.idx2word)
+
+	@classmethod
+	def load(cls, path):
+		vocab_path = os.path.join(path, 'vocab.npy')
+		if os.path.exists(vocab_path):
+			return cls(np.load(vocab_path))
+		# datasets made before vocab.npy only have word_idx.json
+		with open(os.path.join(path, 'word_idx.json'), "r", encoding='utf-8') as f:
+			idx2word = json.load(f)[0]
+		return cls([idx2word[str(idx)] for idx in range(len(idx2word))])
+
+def save_npy(path, array):
+	# written next to `path` and moved into place, so a reader never sees a partial file
+	tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+	with open(tmp_path, 'wb') as f:
+		np.save(f, array)
+	os.replace(tmp_path, path)
+
+def load_embedding_matrix(CONFIG, target_dataset):
+	# copy-on-write mapping: processes on the same host share the pages until one writes to them
+	dataset_path = os.path.join(CONFIG.DATASET_PATH, target_dataset)
+	embedding_path = os.path.join(dataset_path, 'word_embedding.npy')
+	if not os.path.exists(embedding_path):
+		# datasets made before word_embedding.npy only have the pickled matrix
+		with open(os.path.join(dataset_path, 'word_embedding.p'), "rb") as f:
+			save_npy(embedding_path, np.asarray(cPickle.load(f), dtype=np.float32))
+	return torch.from_numpy(np.load(embedding_path, mmap_mode='c'))
+
+def load_weights(model, state_dict):
+	# load_state_dict without copying the checkpoint's word embedding into the model's, which is the
+	# copy-on-write mapping of word_embedding.npy: the copy would give every process a private one
+	model_state = model.state_dict()
+	embedding_keys = [key for key in model_state if key == 'embedding.weight' or key.endswith('.embedding.weight')]
+	weights = dict(state_dict)
+	for key in embedding_keys:
+		if key in weights and torch.equal(weights[key].to(model_state[key].dtype), model_state[key]):
+			del weights[key]
+		elif key in weights:
+			print("{} of the checkpoint differs from word_embedding.npy, loading the checkpoint's".format(key))
+	missing_keys, unexpected_keys = model.load_state_dict(weights, strict=False)
+	missing_keys = [key for key in missing_keys if key not in embedding_keys]
+	if missing_keys or unexpected_keys:
+		raise RuntimeError("checkpoint does not fit the model, missing {} unexpected {}".format(missing_keys, unexpected_keys))
+
+def encode_text(text_list, CONFIG, vocab, chunk_size=10000):
+	text_data = np.empty((len(text_list), CONFIG.MAX_SENTENCE_LEN), dtype=np.int32)
+	for start in tqdm(range(0, len(text_list), chunk_size)):
+		words = []
+		for text in text_list[start:start + chunk_size]:
+			word_list = text.split()
+			if len(word_list) > CONFIG.MAX_SENTENCE_LEN:
+				# truncate sentence if sentence length is longer than `max_sentence_len`
+				word_list = word_list[:CONFIG.MAX_SENTENCE_LEN]
+				word_list[-1] = '<EOS>'
+			else:
+				word_list = word_list + ['<PAD>'] * (CONFIG.MAX_SENTENCE_LEN - len(word_list))
+			words.extend(word_list)
+		indices = vocab.get_indices(words)
+		if (indices < 0).any():
+			raise KeyError(words[int(np.argmax(indices < 0))])
+		text_data[start:start + chunk_size] = indices.reshape(-1, CONFIG.MAX_SENTENCE_LEN)
+	return text_data
+
+def load_text_matrix(CONFIG, target_dataset, text_list, vocab):
+	# (N, MAX_SENTENCE_LEN) int32 word indices of every row of posts.csv,
+	# cached next to it and rebuilt when the vocabulary or posts.csv changes
+	dataset_path = os.path.join(CONFIG.DATASET_PATH, target_dataset)
+	csv_stat = os.stat(os.path.join(dataset_path, 'posts.csv'))
+	key = '{}_{}_{}_{}'.format(vocab.hash(), CONFIG.MAX_SENTENCE_LEN, csv_stat.st_size, csv_stat.st_mtime_ns)
+	cache_path = os.path.join(dataset_path, 'posts_text_{}.npy'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+	if os.path.exists(cache_path):
+		return np.load(cache_path, mmap_mode='r')
+	for old_cache_path in glob(os.path.join(dataset_path, 'posts_text_*.npy')):
+		if old_cache_path != cache_path:
+			try:
+				os.remove(old_cache_path)
+			except FileNotFoundError:
+				pass
+	print("Encoding text...")
+	text_data = encode_text(text_list, CONFIG, vocab)
+	save_npy(cache_path, text_data)
+	return text_data
+
+def get_batch_loader(dataset, batch_size, shuffle, num_workers=0, rank=0, world_size=1, even_shards=True):
+	# the datasets below take a whole batch of indices at once, so the sampler hands out
+	# index lists and the DataLoader does no per-item collation
+	if world_size > 1 and even_shards:
+		# shards padded with repeated posts, so every process takes the same number of steps
+		sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle)
+	elif world_size > 1:
+		sampler = range(rank, len(dataset), world_size)
+	else:
+		sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+	return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None, num_workers=num_workers)
+
+def set_loader_epoch(loader, epoch):
+	# distributed samplers shuffle by epoch, the same way in every process
+	sampler = loader.sampler.sampler if isinstance(loader.sampler, BatchSampler) else loader.sampler
+	if hasattr(sampler, 'set_epoch'):
+		sampler.set_epoch(epoch)
+
+def init_distributed(rank, world_size, master_port):
+	os.environ['MASTER_ADDR'] = '127.0.0.1'
+	os.environ['MASTER_PORT'] = str(master_port)
+	dist.init_process_group('gloo', rank=rank, world_size=world_size)
+	# the cores of the node are split between the processes
+	torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+@contextmanager
+def main_process_first():
+	# the main process builds the dataset caches, the others wait and load them once it is done
+	if not is_main_process():
+		dist.barrier()
+	yield
+	if dist.is_initialized() and is_main_process():
+		dist.barrier()
+
+def is_main_process():
+	return not dist.is_initialized() or dist.get_rank() == 0
+
+def all_reduce_sum(values):
+	# sum of a list of numbers over all processes
+	if not dist.is_initialized():
+		return values
+	tensor = torch.tensor(values, dtype=torch.float64)
+	dist.all_reduce(tensor)
+	return tensor.tolist()
+
+def ignore_frozen_embedding(module):
+	# the frozen embedding is the copy-on-write mapping of word_embedding.npy and the same in every
+	# process; DistributedDataParallel would write it over with rank 0's and unshare the pages
+	names = [name for name, param in module.named_parameters(remove_duplicate=False) if name.endswith('embedding.weight') and not param.requires_grad]
+	DistributedDataParallel._set_params_and_buffers_to_ignore_for_model(module, names)
+
+def average_buffers(module):
+	# running statistics of batch norms are kept per process, the saved model gets their mean
+	if not dist.is_initialized():
+		return
+	state_dict = module.state_dict()
+	for name, buffer in module.named_buffers():
+		if name in state_dict and buffer.is_floating_point():
+			dist.all_reduce(buffer.data)
+			buffer.data.div_(dist.get_world_size())
+
+def read_posts(CONFIG, target_dataset):
+	# shortcode and caption columns of posts.csv as arrays; captions such as "nan" stay strings
+	df_data = pd.read_csv(os.path.join(CONFIG.DATASET_PATH, target_dataset, 'posts.csv'), header=None, usecols=[0, 1],
+						  dtype=str, keep_default_na=False, encoding='utf-8-sig')
+	return df_data[0].values, df_data[1].values
+
+def join_image_features(short_codes, image_store):
+	# (row in posts.csv, row in image_store) of every post that has image features
+	image_rows = image_store.get_rows(short_codes)
+	text_rows = np.flatnonzero(image_rows >= 0)
+	print("Posts without image features dropped: {} of {}".format(len(short_codes) - len(text_rows), len(short_codes)))
+	return np.stack([text_rows, image_rows[text_rows]], axis=1).astype(np.int64)
+
+class BucketBatchSampler(Sampler):
+	# batches of indices whose captions fall in the same length bucket.
+	# with `world_size` processes every process takes every `world_size`-th batch
+	def __init__(self, lengths, buckets, batch_size, shuffle, rank=0, world_size=1, even_shards=True):
+		self.bucket_ids = np.minimum(np.searchsorted(buckets, lengths), len(buckets) - 1)
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.rank = rank
+		self.world_size = world_size
+		self.even_shards = even_shards
+		self.epoch = 0
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	def __iter__(self):
+		# all processes draw the same batches for an epoch
+		generator = torch.Generator().manual_seed(self.epoch) if self.world_size > 1 else None
+		batches = []
+		for bucket_id in np.unique(self.bucket_ids):
+			indices = np.flatnonzero(self.bucket_ids == bucket_id)
+			if self.shuffle:
+				indices = indices[torch.randperm(len(indices), generator=generator).numpy()]
+			batches.extend(np.split(indices, range(self.batch_size, len(indices), self.batch_size)))
+		if self.shuffle:
+			batches = [batches[idx] for idx in torch.randperm(len(batches), generator=generator).tolist()]
+		if self.world_size > 1:
+			if self.even_shards:
+				batches = batches + batches[:(-len(batches)) % self.world_size]
+			batches = batches[self.rank::self.world_size]
+		for batch in batches:
+			yield batch.tolist()
+
+	def __len__(self):
+		n_batches = int(sum(math.ceil(count / self.batch_size) for count in np.bincount(self.bucket_ids) if count > 0))
+		if self.world_size > 1 and self.even_shards:
+			return int(math.ceil(n_batches / self.world_size))
+		return len(range(self.rank, n_batches, self.world_size))
+
+class BucketCollate:
+	# cut a (B, MAX_SENTENCE_LEN) batch down to the smallest bucket that holds its longest caption
+	def __init__(self, buckets, pad_idx):
+		self.buckets = buckets
+		self.pad_idx = pad_idx
+
+	def __call__(self, batch):
+		# multimodal batches are tuples with the text first
+		text = batch[0] if isinstance(batch, tuple) else batch
+		length = int((text != self.pad_idx).sum(dim=1).max())
+		bucket_len = self.buckets[min(np.searchsorted(self.buckets, length), len(self.buckets) - 1)]
+		if isinstance(batch, tuple):
+			return (text[:, :bucket_len],) + batch[1:]
+		return text[:, :bucket_len]
+
+def get_bucket_loader(dataset, batch_size, shuffle, buckets, pad_idx, rank=0, world_size=1, even_shards=True):
+	# buckets are sorted sentence lengths ending with MAX_SENTENCE_LEN
+	text_rows = dataset.data if dataset.data.ndim == 1 else dataset.data[:, 0]
+	lengths = (dataset.text_data[text_rows] != pad_idx).sum(axis=1)
+	sampler = BucketBatchSampler(lengths, buckets, batch_size, shuffle, rank, world_size, even_shards)
+	return DataLoader(dataset, sampler=sampler, batch_size=None, collate_fn=BucketCollate(buckets, pad_idx))
+
+def load_text_data(args, CONFIG, vocab):	
+	short_codes, full_data = read_posts(CONFIG, args.target_dataset)
+	text_data = load_text_matrix(CONFIG, args.target_dataset, full_data, vocab)
 	train_size = int(args.split_rate * len(full_data))
 	val_size = len(full_data) - train_size
-	train_data, val_data = torch.utils.data.random_split(full_data, [train_size, val_size])
-	train_dataset, val_dataset = TextDataset(train_data, CONFIG, word2idx), \
-							 TextDataset(val_data, CONFIG, word2idx)
+	train_data, val_data = torch.utils.data.random_split(range(len(full_data)), [train_size, val_size])
+	train_dataset, val_dataset = TextDataset(np.array(train_data.indices), CONFIG, text_data), \
+							 TextDataset(np.array(val_data.indices), CONFIG, text_data)
 	return train_dataset, val_dataset
 
 class TextDataset(Dataset):
-	def __init__(self, data_list, CONFIG, word2idx):
+	def __init__(self, data_list, CONFIG, text_data):
 		self.data = data_list
-		self.word2idx = word2idx
 		self.CONFIG = CONFIG
+		self.text_data = text_data
 
 	def __len__(self):
 		return len(self.data)
 
 	def __getitem__(self, idx):
-		word_list = self.data[idx].split()
-		index_list = []
-		if len(word_list) > self.CONFIG.MAX_SENTENCE_LEN:
-			# truncate sentence if sentence length is longer than `max_sentence_len`
-			word_list = word_list[:self.CONFIG.MAX_SENTENCE_LEN]
-			word_list[-1] = '<EOS>'
-		else:
-			word_list = word_list + ['<PAD>'] * (self.CONFIG.MAX_SENTENCE_LEN - len(word_list))
-		for word in word_list:
-			index_list.append(self.word2idx[word])
-		text_array = np.array(index_list)
-		text_tensor = torch.from_numpy(text_array).type(torch.LongTensor)
+		# idx is either a single index or a list of indices for a whole batch
+		text_tensor = torch.from_numpy(self.text_data[self.data[idx]].astype(np.int64))
 		return text_tensor
 
 def load_imgseq_data(args, CONFIG):
-	full_data = []
 	print("Using embedding model: ", args.arch)
 	image_dir = os.path.join(CONFIG.DATASET_PATH, args.target_dataset, args.arch)
-	for image_path in tqdm(os.listdir(image_dir)):
-		with open(os.path.join(image_dir, image_path), "rb") as f:
-			image_data = cPickle.load(f)
-		full_data.append(image_data)
-		f.close()
-		del image_data
-	full_data = np.array(full_data, dtype=np.float32)
-	train_size = int(args.split_rate * len(full_data))
-	val_size = len(full_data) - train_size
-	train_data, val_data = torch.utils.data.random_split(full_data, [train_size, val_size])
-	train_dataset, val_dataset = ImgseqDataset(train_data, CONFIG), \
-							 ImgseqDataset(val_data, CONFIG)
+	image_store = ImageFeatureStore(image_dir)
+	train_size = int(args.split_rate * len(image_store))
+	val_size = len(image_store) - train_size
+	train_data, val_data = torch.utils.data.random_split(range(len(image_store)), [train_size, val_size])
+	train_dataset, val_dataset = ImgseqDataset(np.array(train_data.indices), CONFIG, image_store), \
+							 ImgseqDataset(np.array(val_data.indices), CONFIG, image_store)
 	return train_dataset, val_dataset
 
 
 class ImgseqDataset(Dataset):
-	def __init__(self, data_list, CONFIG):
+	def __init__(self, data_list, CONFIG, image_store):
 		self.data = data_list
 		self.CONFIG = CONFIG
+		self.image_store = image_store
 
 	def __len__(self):
 		return len(self.data)
 
 	def __getitem__(self, idx):
-		imgseq_tensor = torch.from_numpy(self.data[idx]).type(torch.FloatTensor)
-		return imgseq_tensor
+		imgseq_tensor = torch.from_numpy(self.image_store.get_features(self.data[idx]))
+		imgseq_len = torch.from_numpy(self.image_store.get_lengths(self.data[idx]))
+		return imgseq_tensor, imgseq_len
 
-def load_multimodal_data(args, CONFIG, word2idx):	
-	full_data = []
-	df_data = pd.read_csv(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'posts.csv'), header=None, encoding='utf-8-sig')
+def load_multimodal_data(args, CONFIG, vocab):	
+	short_codes, text_list = read_posts(CONFIG, args.target_dataset)
 	image_dir = os.path.join(CONFIG.DATASET_PATH, args.target_dataset, args.arch)
-	pbar = tqdm(total=df_data.shape[0])
-	for index, row in df_data.iterrows():
-		pbar.update(1)
-		text_data = row.iloc[1]
-		image_path = os.path.join(image_dir, row.iloc[0]) + '.p'
-		if os.path.exists(image_path):
-			with open(image_path, "rb") as f:
-				image_data = cPickle.load(f)
-			full_data.append([text_data, image_data])
-			del text_data, image_data
-		else:
-			del text_data
-			continue
-	pbar.close()
+	image_store = ImageFeatureStore(image_dir)
+	text_data = load_text_matrix(CONFIG, args.target_dataset, text_list, vocab)
+	full_data = join_image_features(short_codes, image_store)
 	train_size = int(args.split_rate * len(full_data))
 	val_size = len(full_data) - train_size
-	train_data, val_data = torch.utils.data.random_split(full_data, [train_size, val_size])
-	train_dataset, val_dataset = MultimodalDataset(train_data, CONFIG, word2idx), \
-							 MultimodalDataset(val_data, CONFIG, word2idx)
+	train_data, val_data = torch.utils.data.random_split(range(len(full_data)), [train_size, val_size])
+	train_dataset, val_dataset = MultimodalDataset(full_data[train_data.indices], CONFIG, text_data, image_store), \
+							 MultimodalDataset(full_data[val_data.indices], CONFIG, text_data, image_store)
 	return train_dataset, val_dataset
 
 class MultimodalDataset(Dataset):
-	def __init__(self, data_list, CONFIG, word2idx):
+	def __init__(self, data_list, CONFIG, text_data, image_store):
+		# data_list holds (row in text_data, row in image_store) pairs
 		self.data = data_list
-		self.word2idx = word2idx
 		self.CONFIG = CONFIG
+		self.text_data = text_data
+		self.image_store = image_store
 
 	def __len__(self):
 		return len(self.data)
 
 	def __getitem__(self, idx):
-		word_list = self.data[idx][0].split()
-		index_list = []
-		if len(word_list) > self.CONFIG.MAX_SENTENCE_LEN:
-			# truncate sentence if sentence length is longer than `max_sentence_len`
-			word_list = word_list[:self.CONFIG.MAX_SENTENCE_LEN]
-			word_list[-1] = '<EOS>'
-		else:
-			word_list = word_list + ['<PAD>'] * (self.CONFIG.MAX_SENTENCE_LEN - len(word_list))
-		for word in word_list:
-			index_list.append(self.word2idx[word])
-		text_array = np.array(index_list)
-		text_tensor = torch.from_numpy(text_array).type(torch.LongTensor)
-		imgseq_tensor = torch.from_numpy(self.data[idx][1]).type(torch.FloatTensor)
-
-		return text_tensor, imgseq_tensor
-
-def load_fullmultimodal_data(args, CONFIG, word2idx):	
-	full_data = []
-	df_data = pd.read_csv(os.path.join(CONFIG.DATASET_PATH, args.target_dataset, 'posts.csv'), header=None, encoding='utf-8-sig')
+		text_tensor = torch.from_numpy(self.text_data[self.data[idx, 0]].astype(np.int64))
+		imgseq_tensor = torch.from_numpy(self.image_store.get_features(self.data[idx, 1]))
+		imgseq_len = torch.from_numpy(self.image_store.get_lengths(self.data[idx, 1]))
+
+		return text_tensor, imgseq_tensor, imgseq_len
+
+def load_fullmultimodal_data(args, CONFIG, vocab):	
+	short_codes, text_list = read_posts(CONFIG, args.target_dataset)
 	image_dir = os.path.join(CONFIG.DATASET_PATH, args.target_dataset, args.arch)
-	pbar = tqdm(total=df_data.shape[0])
-	for index, row in df_data.iterrows():
-		pbar.update(1)
-		short_code = row.iloc[0]
-		text_data = row.iloc[1]
-		image_path = os.path.join(image_dir, row.iloc[0]) + '.p'
-		if os.path.exists(image_path):
-			with open(image_path, "rb") as f:
-				image_data = cPickle.load(f)
-			full_data.append([text_data, image_data, short_code])
-			del text_data, image_data
-		else:
-			del text_data
-			continue
-	pbar.close()
-	full_dataset = FullMultimodalDataset(full_data, CONFIG, word2idx)
+	image_store = ImageFeatureStore(image_dir)
+	text_data = load_text_matrix(CONFIG, args.target_dataset, text_list, vocab)
+	full_data = join_image_features(short_codes, image_store)
+	full_dataset = FullMultimodalDataset(full_data, CONFIG, text_data, image_store, short_codes[full_data[:, 0]].astype(object))
 	return full_dataset
 
+def input_hashes(full_dataset):
+	# hash of the text and image features every latent of `full_dataset` is encoded from
+	text_hashes = row_hashes(full_dataset.text_data)[full_dataset.data[:, 0]]
+	image_hashes = full_dataset.image_store.get_hashes(full_dataset.data[:, 1])
+	return row_hashes(np.stack([text_hashes, image_hashes], axis=1))
+
 class FullMultimodalDataset(Dataset):
-	def __init__(self, data_list, CONFIG, word2idx):
+	def __init__(self, data_list, CONFIG, text_data, image_store, short_codes):
 		self.data = data_list
-		self.word2idx = word2idx
 		self.CONFIG = CONFIG
+		self.text_data = text_data
+		self.image_store = image_store
+		self.short_codes = short_codes
 
 	def __len__(self):
 		return len(self.data)
 
 	def __getitem__(self, idx):
-		word_list = self.data[idx][0].split()
-		index_list = []
-		if len(word_list) > self.CONFIG.MAX_SENTENCE_LEN:
-			# truncate sentence if sentence length is longer than `max_sentence_len`
-			word_list = word_list[:self.CONFIG.MAX_SENTENCE_LEN]
-			word_list[-1] = '<EOS>'
-		else:
-			word_list = word_list + ['<PAD>'] * (self.CONFIG.MAX_SENTENCE_LEN - len(word_list))
-		for word in word_list:
-			index_list.append(self.word2idx[word])
-		text_array = np.array(index_list)
-		text_tensor = torch.from_numpy(text_array).type(torch.LongTensor)
-		imgseq_tensor = torch.from_numpy(self.data[idx][1]).type(torch.FloatTensor)
+		text_tensor = torch.from_numpy(self.text_data[self.data[idx, 0]].astype(np.int64))
+		imgseq_tensor = torch.from_numpy(self.image_store.get_features(self.data[idx, 1]))
+		imgseq_len = torch.from_numpy(self.image_store.get_lengths(self.data[idx, 1]))
 
-		return text_tensor, imgseq_tensor, self.data[idx][2]
+		return text_tensor, imgseq_tensor, imgseq_len, self.short_codes[idx]
 
 def transform_idx2word(index, idx2word):
-	return " ".join([idx2word[str(idx)] for idx in index])
+	return " ".join(idx2word[np.asarray(index)])
 
 
 def save_models(checkpoint, path, prefix):
@@ -1,45 +1,170 @@
 from polyglot.detect import Detector
 from konlpy.tag import Okt
+import config
 import re
 import nltk
 import sys
+import multiprocessing
+import sqlite3
+import hashlib
+from itertools import islice
 from nltk.tokenize import word_tokenize, sent_tokenize
 from nltk.tag import pos_tag
 
+CONFIG = config.Config
 okt=Okt()
 expression = re.compile('[ㄱ-ㅣ가-힣|a-zA-Z|\s]+') 
-def process_text(text_data):
+# bump whenever process_text may return different tokens for the same caption
+TOKENIZER_VERSION = '2'
+
+def normalize_text(text_data):
 	text_data = ''.join(x for x in text_data if x.isprintable())
 	text_data = text_data.replace("#", " ")
 	text_data = text_data.replace("\n", " ")
-	languages = Detector(text_data, quiet=True).languages
+	return text_data
 
+# plain-ASCII captions are chunked here the same way Okt chunks them (Number before Alpha,
+# runs of punctuation as one token); anything Okt could read as URL, Email, ScreenName
+# or CashTag goes through okt.pos instead.
+fast_path_excluded = re.compile(r'[@$]|://|[A-Za-z0-9]\.[A-Za-z]')
+fast_path_token = re.compile(r'(?P<Number>[0-9]+(?:,[0-9]{3})*(?:[/~:.\-][0-9]+)?%?)|(?P<Alpha>[A-Za-z]+)|(?P<Punctuation>[!-/:-@\[-`{-~]+)')
+
+def append_word(word_list, word):
+	if word == '그램':
+		if len(word_list) > 0:
+			if word_list[-1] == '스타':
+				word_list[-1] = '스타그램'
+			elif word_list[-1] == '맛스타':
+				word_list[-1] = '맛스타그램'
+			else:
+				word_list.append(word)
+		else:
+			word_list.append(word)
+	else:
+		word_list.append(word)
+
+def okt_tokenize(text_data):
+	word_list = []
+	tokens = okt.pos(text_data)
+	#print(tokens)
+	for token in tokens:
+		word = token[0]
+		if token[1] in ['Foreign', 'Number', 'URL', 'Email', 'ScreenName', 'Hashtag']:
+			# all Hashtag remaining are Japanese
+			continue
+		elif token[1] == 'Alpha':
+			word = word.lower()
+		append_word(word_list, word)
+	return word_list
+
+def is_fast_text(text_data):
+	return text_data.isascii() and fast_path_excluded.search(text_data) is None
+
+def fast_tokenize(text_data):
+	word_list = []
+	for match in fast_path_token.finditer(text_data):
+		if match.lastgroup == 'Number':
+			continue
+		elif match.lastgroup == 'Alpha':
+			append_word(word_list, match.group().lower())
+		else:
+			append_word(word_list, match.group())
+	return word_list
+
+def process_text(text_data):
+	text_data = normalize_text(text_data)
+	languages = Detector(text_data, quiet=True).languages
 
 	word_list = []
 	if languages[0].code in ["ko", "en"]:
-		tokens = okt.pos(text_data)
-		#print(tokens)
-		for token in tokens:
-			word = token[0]
-			if token[1] in ['Foreign', 'Number', 'URL', 'Email', 'ScreenName', 'Hashtag']:
-				# all Hashtag remaining are Japanese
-				continue
-			elif token[1] == 'Alpha':
-				word = word.lower()
-			if word == '그램':
-				if len(word_list) > 0:
-					if word_list[-1] == '스타':
-						word_list[-1] = '스타그램'
-					elif word_list[-1] == '맛스타':
-						word_list[-1] = '맛스타그램'
-					else:
-						word_list.append(word)
-				else:
-					word_list.append(word)
-			else:
-				word_list.append(word)		
+		if is_fast_text(text_data):
+			word_list = fast_tokenize(text_data)
+			if CONFIG.VERIFY_FAST_TOKENIZER:
+				okt_word_list = okt_tokenize(text_data)
+				if okt_word_list != word_list:
+					print("fast tokenizer mismatch: ", text_data)
+					print(word_list)
+					print(okt_word_list)
+					word_list = okt_word_list
+		else:
+			word_list = okt_tokenize(text_data)
 	return word_list
 
+class TokenCache:
+	# on-disk map from (tokenizer version, normalized caption) to its token list
+	def __init__(self, path):
+		self.conn = sqlite3.connect(path)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		self.conn.execute('CREATE TABLE IF NOT EXISTS tokens (key BLOB PRIMARY KEY, words TEXT NOT NULL)')
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	@staticmethod
+	def make_key(text_data):
+		return hashlib.sha1((TOKENIZER_VERSION + '\0' + normalize_text(text_data)).encode('utf-8')).digest()
+
+	def get_many(self, keys):
+		cached = {}
+		unique_keys = list(set(keys))
+		# stay below sqlite's limit on bound variables
+		for start in range(0, len(unique_keys), 500):
+			chunk = unique_keys[start:start + 500]
+			query = 'SELECT key, words FROM tokens WHERE key IN ({})'.format(','.join('?' * len(chunk)))
+			for key, words in self.conn.execute(query, chunk):
+				cached[key] = words.split()
+		return cached
+
+	def put_many(self, items):
+		self.conn.executemany('INSERT OR REPLACE INTO tokens (key, words) VALUES (?, ?)',
+							  [(key, ' '.join(word_list)) for key, word_list in items])
+		self.conn.commit()
+
+	def close(self):
+		self.conn.close()
+
+def _process_block(block, pool, chunksize):
+	if pool is None:
+		return [process_text(text_data) for text_data in block]
+	return pool.map(process_text, block, chunksize)
+
+def iter_process_text(text_iter, num_workers=1, chunksize=256, cache=None):
+	# tokenize captions over a pool of worker processes, yielding in input order.
+	# 'spawn' gives every worker a fresh import of this module, hence its own Okt/JVM.
+	# with a TokenCache only captions that were never seen before reach the pool.
+	pool = None
+	if num_workers is not None and num_workers > 1:
+		pool = multiprocessing.get_context('spawn').Pool(num_workers)
+	block_size = max(num_workers or 1, 1) * chunksize * 4
+	text_iter = iter(text_iter)
+	try:
+		while True:
+			block = list(islice(text_iter, block_size))
+			if len(block) == 0:
+				break
+			if cache is None:
+				word_list_list = _process_block(block, pool, chunksize)
+			else:
+				keys = [cache.make_key(text_data) for text_data in block]
+				cached = cache.get_many(keys)
+				missing = [idx for idx, key in enumerate(keys) if key not in cached]
+				processed = _process_block([block[idx] for idx in missing], pool, chunksize)
+				cache.put_many([(keys[idx], word_list) for idx, word_list in zip(missing, processed)])
+				cached.update((keys[idx], word_list) for idx, word_list in zip(missing, processed))
+				word_list_list = [cached[key] for key in keys]
+			for word_list in word_list_list:
+				yield word_list
+	finally:
+		if pool is not None:
+			pool.terminate()
+
+def process_text_list(text_list, num_workers=1, chunksize=256, cache=None):
+	return list(iter_process_text(text_list, num_workers, chunksize, cache))
+
 def temp(text_data):
 	text_data = [re.findall(expression, x) for x in text_data if x.isprintable()]
 	word_list = []